@@ -22,11 +22,16 @@
 __author__ = 'Garrett Hickman'
 # import logging
 # logger = logging.getLogger(__name__)
+import os
+import sys
+import json
 import time
+import threading
+import Queue
+import collections
 import PyCapture2
 
 import numpy
-import scipy.ndimage.measurements as measurements
 from scipy.ndimage.morphology import binary_opening
 from scipy.optimize import curve_fit
 
@@ -52,6 +57,7 @@ class BlackflyCamera(object):
         # initializes the 'data' varable for holding image data
         self.data = []
         self.error = 0
+        self.stats = {}
         self.status = 'STOPPED'
         # creates an array to hold camera data for one image
         # self.data.append(numpy.zeros(self.cam_resolution, dtype=float))
@@ -60,13 +66,127 @@ class BlackflyCamera(object):
         self.parameters = {
             'serial': 16483677,  # should this be hardcoded? MK
             'triggerDelay': 0,
-            'exposureTime': 1
+            'exposureTime': 1,
+            # 'drop': retrieveBuffer returns only the newest frame
+            # 'buffer': frames queue up in numBuffers driver buffers
+            'grabMode': 'drop',
+            'numBuffers': 10,
+            # measurements kept for GET_RESULTS_SINCE queries
+            'historyLength': 1000,
+            # 'sparse' works on the above-threshold pixel list, 'dense' on
+            # full-frame masks; both give the same centroid
+            'centroidMethod': 'sparse',
+            # binary_opening of the above-threshold pixels before the centroid
+            'opening': True,
+            # report frame-sized buffers created per shot as ALLOC<shot> in stats
+            'debugAllocations': False,
+            # analyse shot n on a worker thread while shot n+1 is read out
+            'pipelineShots': False,
+            # per-pixel background subtraction, see BackgroundModel
+            'backgroundModel': {
+                'enable': False,
+                'alpha': 0.05,  # EMA weight given to each new dark frame
+                'gateLevel': 40  # frames with EV at or above this are skipped
+            },
+            # closed-loop exposure control, see ExposureController
+            'autoExposure': {
+                'enable': False,
+                'targetLow': 150,  # EV band to steer into
+                'targetHigh': 230,
+                'darkLevel': 5,  # EV with no light, used until it is fitted
+                # ms; the shutter response is only calibrated, and linear,
+                # between these two, see shutter_to_exposure
+                'minExposure': 0.08,
+                'maxExposure': 18.0,
+                'minInterval': 0.5,  # s between exposure writes
+                'history': 8  # (exposure, EV) pairs used for the model
+            },
+            # matched-filter intensity of each lattice site, see SiteFilter
+            'siteReadout': {
+                'enable': False,
+                'numSites': 5,
+                'spacing': 41,  # px between sites along x
+                'sigmaX': 15,  # px, spot size used for the weights
+                'sigmaY': 20,
+                'tolerance': 0.5,  # px the lattice may move before a rebuild
+                'occupancyThreshold': 10  # peak counts for an occupied site
+            },
+            # seed each fit with the last converged parameters of the shot
+            'warmStart': {
+                'enable': False,
+                'maxfev': 50,  # evaluation budget per warm started fit
+                'maxShift': 3.0  # px; beyond this the fit starts cold
+            },
+            # FFT correlation against a reference frame instead of fits
+            'driftTracking': {
+                'enable': False,
+                'size': [128, 256]  # rows, cols of the tracked region
+            },
+            # static hot pixel correction, see DefectMap
+            'defectMap': {
+                'enable': True,  # use a cached map if one exists for the ROI
+                'directory': 'defect_maps',
+                'numFrames': 20,  # dark frames per calibration run
+                'nSigma': 6.0,
+                'mode': 'interpolate'  # or 'mask'
+            },
+            # shrink the hardware ROI around the signal, see auto_roi
+            'autoROI': {
+                'enable': False,
+                'shot': 0,  # shot whose position the window follows
+                'width': 320,  # px, size of the tight window
+                'height': 160,
+                'margin': 40  # px; closer to an edge and the window grows
+            },
+            # packet size / inter-packet delay sweep, see tune_stream
+            'streamTuning': {
+                'useSaved': True,  # apply the tuned setting for this NIC
+                'directory': 'stream_settings',
+                'packetSizes': [1400, 4000, 9000],  # bytes
+                'interPacketDelays': [0, 400, 1600, 6400],  # ticks
+                'numFrames': 20  # triggered frames per candidate
+            }
         }
 
-        for key in parameters:
-            self.parameters[key] = parameters[key]
+        merge_parameters(self.parameters, parameters)
 
         self.imageNum = 0
+        # background models indexed by shot number
+        self.background = {}
+        # hot pixel map for the current serial and ROI, None if not calibrated
+        self.defects = None
+        # frame-sized analysis buffers, reused from shot to shot
+        self.workspace = AnalysisWorkspace()
+        # reference regions per shot for drift tracking, reset by update()
+        self.drift_trackers = {}
+        self.drift_reference = {}
+        # converged fit parameters per (shot, axis), see warm_fit
+        self.fit_cache = {}
+        # last good fitted (x, y) per shot and the site weights built from it
+        self.site_geometry = {}
+        self.site_filters = {}
+        # frames copied out of the driver buffers but not yet analysed
+        self.frame_queue = collections.deque()
+        self.frames_drained = 0
+        # past measurements, oldest first, see results_since
+        self.history = collections.deque(maxlen=self.parameters['historyLength'])
+        self.sequence = 0
+        # (seq, error, frames) of the last finished measurement, see last_frames
+        self.frames = (0, 0, [])
+        # camera timestamp (s) of the first frame of the last measurement
+        # and the host time it was taken out of the driver
+        self.stamp = None
+        self.received = None
+        # image settings chosen by auto_roi, written by start_capture
+        self.pending_roi = None
+        # camera step sizes and sensor size, see image_settings_info
+        self.settings_info = None
+        # host network the camera streams to, see nic_key
+        self.nic = None
+        # inter-packet delay set by the server's bandwidth plan, or None
+        self.scheduled_delay = None
+        # (grabMode, numBuffers) last written to the driver, see SetGrabMode
+        self.grab_config = None
 
     def __del__(self):
         # if self.isInitialized:
@@ -133,26 +253,52 @@ class BlackflyCamera(object):
         trigger_mode.polarity = 1
         trigger_mode.source = 0  # specifies an external hardware trigger
         self.camera_instance.setTriggerMode(trigger_mode)
-        # # Sets the camera grab mode:
-        # # 0 = The camera retrieves only the newest image from the buffer each time the RetrieveBuffer() function
-        # #     is called. Older images will be dropped. See p. 93 in the PyCapture 2 API Reference manual.
-        # # 1 = The camera retrieves the oldest image from the buffer each time RetrieveBuffer() is called.
-        # #     Ungrabbed images will accumulated until the buffer is full, after which the oldest will be deleted.
-        PyCapture2.GRAB_MODE = 0
+        # the grab mode is configured by SetGrabMode in update()
         self.isInitialized = True
 
     def update(self, parameters={}):
         # sends parameters that have been updated in software to the cameras,
         # if camera is "enabled"
-        for key in parameters:
-            self.parameters[key] = parameters[key]
+        merge_parameters(self.parameters, parameters)
+        # new settings may move the image, so take new drift references
+        self.drift_trackers = {}
+        self.drift_reference = {}
+        # an explicit ROI wins over one auto_roi has not written yet
+        self.pending_roi = None
 
+        self.SetGrabMode(self.parameters['grabMode'], self.parameters['numBuffers'])
         self.SetTriggerDelay(self.parameters['triggerDelay'])
         self.SetExposureTime(self.parameters['exposureTime'])
         self.SetGigEConfig(self.parameters['gigEConfig'])
-        self.SetGigEStreamChannel(self.parameters['gigEStreamChannel'])
+        self.SetGigEStreamChannel(self.stream_channel())
         # print self.camera_instance.getGigEStreamChannelInfo(0).__dict__
         self.SetGigEImageSettings(self.parameters['gigEImageSettings'])
+        self.load_defect_map()
+        self.workspace.resize(self.roi_shape())
+
+    def SetGrabMode(self, grabMode, numBuffers):
+        """Configure how the driver keeps frames between retrieveBuffer calls.
+
+        'drop': retrieveBuffer returns only the newest image, older images are
+            dropped. See p. 93 in the PyCapture 2 API Reference manual.
+        'buffer': retrieveBuffer returns the oldest image. Ungrabbed images
+            accumulate in numBuffers buffers, after which the oldest is lost.
+
+        The driver is only reconfigured when the mode changed and the camera
+        is not streaming; start_capture writes a change made while it was.
+        """
+        config = (grabMode, numBuffers)
+        if config == self.grab_config or self.status == 'ACQUIRING':
+            return
+        if grabMode == 'buffer':
+            mode = PyCapture2.GRAB_MODE.BUFFER_FRAMES
+        else:
+            mode = PyCapture2.GRAB_MODE.DROP_FRAMES
+        self.camera_instance.setConfiguration(
+            numBuffers=numBuffers,
+            grabMode=mode
+        )
+        self.grab_config = config
 
     # Sets the delay between external trigger and frame acquisition
     def SetTriggerDelay(self, triggerDelay):
@@ -165,6 +311,210 @@ class BlackflyCamera(object):
         self.camera_instance.setGigEImageSettings(**gigEImageSettings)
         # print self.camera_instance.getGigEImageSettings().__dict__
 
+    def nic_key(self):
+        """Name the host link of this camera by its IPv4 network address.
+
+        Tuned stream settings depend on the NIC and switch as much as on the
+        camera, so they are stored per serial and network.
+        """
+        if self.nic is None:
+            info = self.camera_instance.getCameraInfo()
+            try:
+                ip = [int(b) for b in info.ipAddress]
+                mask = [int(b) for b in info.subnetMask]
+            except (AttributeError, TypeError, ValueError):
+                self.nic = 'default'
+            else:
+                self.nic = '.'.join(str(a & m) for a, m in zip(ip, mask))
+        return self.nic
+
+    def stream_channel(self):
+        """Configured gigEStreamChannel, overridden by a saved tuning."""
+        stream = dict(self.parameters.get('gigEStreamChannel', {}))
+        settings = self.parameters['streamTuning']
+        if settings['useSaved']:
+            saved = load_stream_settings(
+                settings['directory'],
+                self.parameters['serial'],
+                self.nic_key()
+            )
+            if saved is not None:
+                stream.update(saved)
+        if self.scheduled_delay is not None:
+            # the link is shared, the server's plan decides the spacing
+            stream['interPacketDelay'] = self.scheduled_delay
+        return stream
+
+    def schedule_packet_delay(self, ticks):
+        """Use `ticks` as inter-packet delay from now on (None to release).
+
+        Only the delay is written, the packet size stays as it is.
+        """
+        self.scheduled_delay = ticks
+        delay = self.stream_channel().get('interPacketDelay')
+        if delay is not None:
+            self.SetGigEStreamChannel({'interPacketDelay': delay})
+
+    def packet_size(self):
+        """Packet size in bytes the camera currently streams with."""
+        ptype = PyCapture2.GIGE_PROPERTY_TYPE.GIGE_PACKET_SIZE
+        return self.camera_instance.getGigEProperty(ptype).value
+
+    def frame_bytes(self):
+        """Image payload of one frame with the current ROI and pixel format."""
+        settings = self.parameters['gigEImageSettings']
+        size = bytes_per_pixel(settings.get('pixelFormat'))
+        return int(numpy.ceil(settings['width'] * settings['height'] * size))
+
+    def tune_stream(self, packetSizes=None, interPacketDelays=None, num_frames=None):
+        """Sweep packet size and inter-packet delay, keep the best setting.
+
+        Every combination streams `num_frames` hardware triggered frames, so
+        the experiment must keep triggering while this runs. Candidates are
+        ranked by failed frames, then resend requests, then frame rate. The
+        winner is applied, written to gigEStreamChannel and saved for this
+        serial and NIC.
+
+        @return (best setting or None, list of per-candidate results)
+        """
+        settings = self.parameters['streamTuning']
+        if packetSizes is None:
+            packetSizes = settings['packetSizes']
+        if interPacketDelays is None:
+            interPacketDelays = settings['interPacketDelays']
+        if num_frames is None:
+            num_frames = settings['numFrames']
+        was_acquiring = self.status == 'ACQUIRING'
+        if was_acquiring:
+            self.camera_instance.stopCapture()
+        results = []
+        try:
+            for packetSize in packetSizes:
+                for interPacketDelay in interPacketDelays:
+                    result = {
+                        'packetSize': packetSize,
+                        'interPacketDelay': interPacketDelay
+                    }
+                    try:
+                        self.SetGigEStreamChannel(result)
+                        result.update(self.measure_stream(num_frames))
+                    except PyCapture2.Fc2error as fc2Err:
+                        # e.g. a packet size above the NIC's MTU
+                        result['error'] = str(fc2Err)
+                    results.append(result)
+            valid = [r for r in results if 'error' not in r and r['fps'] > 0]
+            best = None
+            if valid:
+                ranked = min(valid, key=lambda r: (r['failed'], r['resends'], -r['fps']))
+                best = {
+                    'packetSize': ranked['packetSize'],
+                    'interPacketDelay': ranked['interPacketDelay']
+                }
+                self.parameters.setdefault('gigEStreamChannel', {}).update(best)
+                save_stream_settings(
+                    settings['directory'],
+                    self.parameters['serial'],
+                    self.nic_key(),
+                    best
+                )
+        finally:
+            # the winner, or whatever was configured before the sweep
+            self.SetGigEStreamChannel(self.stream_channel())
+            if was_acquiring:
+                self.camera_instance.startCapture()
+        return best, results
+
+    def measure_stream(self, num_frames):
+        """Stream num_frames frames with the current stream settings.
+
+        @return dict with the achieved fps, resend requests and failed frames
+        """
+        before = self.resend_count()
+        failed = 0
+        self.camera_instance.startCapture()
+        start = time.time()
+        try:
+            for i in range(num_frames):
+                try:
+                    self.camera_instance.retrieveBuffer()
+                except PyCapture2.Fc2error:
+                    failed += 1  # timeouts and image consistency errors
+        finally:
+            elapsed = time.time() - start
+            self.camera_instance.stopCapture()
+        return {
+            'fps': (num_frames - failed) / elapsed if elapsed > 0 else 0.0,
+            'resends': self.resend_count() - before,
+            'failed': failed
+        }
+
+    def resend_count(self):
+        """Packet resends the driver has requested from this camera."""
+        stats = self.camera_instance.getStats()
+        return getattr(stats, 'numResendPacketsRequested', 0)
+
+    def image_settings_info(self):
+        """Return the camera's GigE image settings limits (cached)."""
+        if self.settings_info is None:
+            self.settings_info = self.camera_instance.getGigEImageSettingsInfo()
+        return self.settings_info
+
+    def auto_roi(self):
+        """Choose the readout window around the signal of the tracked shot.
+
+        The window is the configured size around the fitted position while
+        the signal stays `margin` px away from its edges. Closer to an edge
+        it doubles (up to the full sensor) around the new position, and it
+        opens to the full sensor when the signal is lost. The choice is only
+        written by start_capture, because the image settings cannot change
+        while the camera streams.
+        """
+        settings = self.parameters['autoROI']
+        current = self.parameters['gigEImageSettings']
+        info = self.image_settings_info()
+        shot = settings['shot']
+        X = self.stats.get('X{}'.format(shot), numpy.NaN)
+        Y = self.stats.get('Y{}'.format(shot), numpy.NaN)
+        if not (numpy.isfinite(X) and numpy.isfinite(Y)):
+            x, y = info.maxWidth / 2.0, info.maxHeight / 2.0
+            width, height = info.maxWidth, info.maxHeight
+        else:
+            # X/Y are in the atom plane, go back to sensor pixels
+            conv = self.conversion(shot)
+            x, y = X / conv, Y / conv
+            margin = settings['margin']
+            inside = (
+                current['offsetX'] + margin <= x < current['offsetX'] + current['width'] - margin and
+                current['offsetY'] + margin <= y < current['offsetY'] + current['height'] - margin
+            )
+            if inside:
+                width, height = settings['width'], settings['height']
+                if current['width'] <= width and current['height'] <= height:
+                    return None
+            else:
+                width = max(2 * current['width'], settings['width'])
+                height = max(2 * current['height'], settings['height'])
+        roi = dict(current)
+        roi.update(aligned_roi(x, y, width, height, info))
+        if roi != current:
+            self.pending_roi = roi
+        return self.pending_roi
+
+    def apply_roi(self, gigEImageSettings):
+        """Write new image settings and drop the state tied to the old ROI."""
+        self.pending_roi = None
+        self.parameters['gigEImageSettings'] = gigEImageSettings
+        self.SetGigEImageSettings(gigEImageSettings)
+        # all of these hold ROI pixel coordinates or ROI sized frames
+        self.background = {}
+        self.drift_trackers = {}
+        self.drift_reference = {}
+        self.fit_cache = {}
+        self.site_geometry = {}
+        self.site_filters = {}
+        self.load_defect_map()
+        self.workspace.resize(self.roi_shape())
+
     def SetGigEStreamChannel(self, gigEStreamChannel):
         if 'packetSize' in gigEStreamChannel:
             ptype = PyCapture2.GIGE_PROPERTY_TYPE.GIGE_PACKET_SIZE
@@ -201,9 +551,7 @@ class BlackflyCamera(object):
         # The maximum value is 4095.
         # For values between 5 and 1000, shutter time is very well approximated
         # by: t = (shutter_value*18.81 - 22.08) us
-        shutter_value = int(round((exposureTime*1000+22.08)/18.81))
-        if shutter_value > 4095:
-            shutter_value = 4095
+        shutter_value = exposure_to_shutter(exposureTime)
         bits20_31 = format(shutter_value, '012b')
         print exposureTime
         print shutter_value
@@ -216,29 +564,131 @@ class BlackflyCamera(object):
 
     def sanity_check(self, data):
         nth_largest=10
-        value=numpy.partition(data.flatten(),-nth_largest)[-nth_largest]
+        scratch = self.workspace.get('index', numpy.intp, data.shape)
+        value=nth_largest_value(data,nth_largest,scratch)
         return value
 
+    def subtract_background(self, data, shot, EV):
+        """Update the shot's background model and subtract it in place.
+
+        The model only learns from frames whose exposure value is below the
+        configured gate level, so shots with atoms or lasers in them never
+        contaminate the background estimate.
+        """
+        settings = self.parameters['backgroundModel']
+        try:
+            model = self.background[shot]
+        except KeyError:
+            model = BackgroundModel(settings['alpha'], settings['gateLevel'])
+            self.background[shot] = model
+        model.alpha = settings['alpha']
+        model.gate_level = settings['gateLevel']
+        if EV < model.gate_level:
+            model.update(data)
+        model.subtract(data)
+
+    def roi_key(self):
+        """Return the (offsetX, offsetY, width, height) of the current ROI."""
+        settings = self.parameters['gigEImageSettings']
+        return tuple(settings[k] for k in ('offsetX', 'offsetY', 'width', 'height'))
+
+    def roi_shape(self):
+        """Return the (rows, cols) shape of frames read out with the current ROI."""
+        settings = self.parameters['gigEImageSettings']
+        return (settings['height'], settings['width'])
+
+    def load_defect_map(self):
+        """Load this camera's cached defect map, cropped to the current ROI."""
+        settings = self.parameters['defectMap']
+        self.defects = None
+        if settings['enable']:
+            self.defects = DefectMap.load(
+                settings['directory'],
+                self.parameters['serial'],
+                self.roi_key()
+            )
+        return self.defects
+
+    def calibrate_defects(self, num_frames=None):
+        """Build and cache a defect map from a run of dark frames.
+
+        The camera stays hardware triggered, so the experiment must supply
+        `num_frames` triggers with the imaging light blocked.
+        """
+        settings = self.parameters['defectMap']
+        if num_frames is None:
+            num_frames = settings['numFrames']
+        frames = []
+        was_acquiring = self.status == 'ACQUIRING'
+        if not was_acquiring:
+            self.camera_instance.startCapture()
+        try:
+            for i in range(num_frames):
+                image = self.camera_instance.retrieveBuffer()
+                frames.append(self.image_to_array(image))
+        finally:
+            if not was_acquiring:
+                self.camera_instance.stopCapture()
+        self.defects = DefectMap.from_dark_frames(
+            self.parameters['serial'],
+            self.roi_key(),
+            frames,
+            settings['nSigma']
+        )
+        self.defects.save(settings['directory'])
+        return self.defects
+
     def centroid_calc(self, data):
         #percentile = 98
         nth_largest= 8000
         # Set threshold based on the percentile
-        threshold=numpy.partition(data.flatten(),-nth_largest)[-nth_largest]
+        scratch = self.workspace.get('index', numpy.intp, data.shape)
+        threshold=nth_largest_value(data, nth_largest, scratch)
         #threshold = numpy.percentile(data, percentile)
+        if self.parameters['centroidMethod'] == 'dense':
+            return self.centroid_calc_dense(data, threshold)
+        # Only the few thousand pixels above threshold are kept from here on
+        mask = self.workspace.get('mask', bool, data.shape)
+        flat = numpy.flatnonzero(numpy.greater(data, threshold, out=mask))
+        if self.parameters['opening']:
+            # Apply dilation-erosion to exclude possible noise
+            flat = sparse_opening(flat, data.shape)
+        signal = SparseImage(flat, data.flat[flat], data.shape)
+        if len(flat) == 0: # if there is no signal, assign NaN
+           [COM_Y, COM_X]=[numpy.nan,numpy.nan]
+           self.error=1
+        else:
+           [COM_Y, COM_X] = signal.center_of_mass()
+        return COM_X, COM_Y, signal
+
+    def centroid_calc_dense(self, data, threshold):
+        """Full-frame reference implementation of centroid_calc."""
         # Mask pixels having brightness less than given threshold
-        thresholdmask = data > threshold
-        # Apply dilation-erosion to exclude possible noise
-        openingmask = binary_opening(thresholdmask)
-        temp=numpy.ma.array(data, mask=numpy.invert(openingmask))
-        temp2=temp.filled(0)
+        thresholdmask = numpy.greater(
+            data, threshold, out=self.workspace.get('mask', bool, data.shape))
+        if self.parameters['opening']:
+            # Apply dilation-erosion to exclude possible noise
+            openingmask = opening_in_roi(
+                thresholdmask, self.workspace.get('opened', bool, data.shape))
+        else:
+            openingmask = thresholdmask
+        # zero the pixels outside the mask
+        temp2 = numpy.multiply(
+            data, openingmask, out=self.workspace.get('signal', data.dtype, data.shape))
         if threshold>numpy.max(temp2): # if there is no signal, assign NaN
            [COM_Y, COM_X]=[numpy.nan,numpy.nan]
            self.error=1
         else:
-           [COM_Y, COM_X] = measurements.center_of_mass(temp2)  # Center of mass.
+           # Center of mass, from the projections rather than scipy's
+           # frame-sized coordinate products
+           data_y = numpy.sum(temp2, axis=1, dtype=numpy.float64)
+           data_x = numpy.sum(temp2, axis=0, dtype=numpy.float64)
+           total = data_y.sum()
+           COM_Y = numpy.dot(numpy.arange(len(data_y)), data_y) / total
+           COM_X = numpy.dot(numpy.arange(len(data_x)), data_x) / total
         return COM_X, COM_Y, temp2
 
-    def calculate_statistics(self,data,shot):
+    def conversion(self, shot):
         # Shot dependent magnification.
         # This will convert the camera location into atom plane distance in um
         #
@@ -250,32 +700,60 @@ class BlackflyCamera(object):
         # From 2018/07/04, trying [21.12,17.589]
         [mag_Red, mag_FORT]=[18.054, 18.3403]
         [conv_Red, conv_FORT]=[PG_pixelsize/mag_Red, PG_pixelsize/mag_FORT]
+        if shot==0: # Red is configured to be the first shot
+            return conv_Red
+        return conv_FORT
+
+    def calculate_statistics(self,data,shot):
+        conv = self.conversion(shot)
         self.error=0 # initialize error flag to zero
         if shot == 0:
             self.stats = {}  # If this is the first shot, empty the stat.
         offsetX=self.parameters['gigEImageSettings']['offsetX'] # Image acqiured from the camera may not be at full screen. Add offset to pass absolute positions.
         offsetY=self.parameters['gigEImageSettings']['offsetY']
+        if self.defects is not None:
+            # patch known hot pixels before anything looks at the frame
+            self.defects.apply(data, self.parameters['defectMap']['mode'])
         # Get initial guesses
         EV = self.sanity_check(data) # measure of correct exposure. 0 to 255
         self.stats['EV{}'.format(shot)] = float(EV)
         if EV==255:
             self.error=1
             print "Overexposed"
+        if self.parameters['backgroundModel']['enable']:
+            self.subtract_background(data, shot, EV)
+        tracking = self.parameters['driftTracking']['enable']
+        if tracking and shot in self.drift_trackers:
+            # cheap path: only the shift against the reference frame
+            self.track_drift(data, shot)
+            return
         Centroid_X, Centroid_Y, preconditioned_data = self.centroid_calc(data)
 
         if self.error==0:
-            img,offsetx,offsety = img_crop(preconditioned_data,Centroid_X, Centroid_Y)
-            Fit_values_x, error_x = gaussianfit_x(preconditioned_data,Centroid_X)
-            Fit_values_y, error_y = gaussianfit_y(preconditioned_data,Centroid_Y)
+            data_x = projection(preconditioned_data, 0)
+            data_y = projection(preconditioned_data, 1)
+            Fit_values_x, error_x, nfev_x = self.warm_fit(
+                fit_sites_x, data_x, Centroid_X, x_guesses, (shot, 'x'))
+            Fit_values_y, error_y, nfev_y = self.warm_fit(
+                fit_site_y, data_y, Centroid_Y, y_guesses, (shot, 'y'))
+            # function evaluations spent on this shot's fits
+            self.stats['NFEV{}'.format(shot)] = nfev_x + nfev_y
             if error_x==0 and error_y==0:
                 [centerx,centery] = [Fit_values_x,Fit_values_y]
+                if numpy.isfinite(centerx) and numpy.isfinite(centery):
+                    self.site_geometry[shot] = (centerx, centery)
                 [location_X, location_Y]=[centerx+offsetX, centery+offsetY]
-                if shot==0: # Red is configured to be the first shot
-                    [atomplane_X, atomplane_Y]=[conv_Red*location_X, conv_Red*location_Y]
-                elif shot==1:
-                    [atomplane_X, atomplane_Y]=[conv_FORT*location_X, conv_FORT*location_Y]
+                [atomplane_X, atomplane_Y]=[conv*location_X, conv*location_Y]
                 self.stats['X{}'.format(shot)] = atomplane_X
                 self.stats['Y{}'.format(shot)] = atomplane_Y
+                if tracking and numpy.isfinite(atomplane_X) and numpy.isfinite(atomplane_Y):
+                    # this frame becomes the reference for drift tracking
+                    self.drift_trackers[shot] = DriftTracker(
+                        data,
+                        (centery, centerx),
+                        self.parameters['driftTracking']['size']
+                    )
+                    self.drift_reference[shot] = (atomplane_X, atomplane_Y)
             else:
                 self.error=1
 
@@ -283,49 +761,380 @@ class BlackflyCamera(object):
             self.stats['X{}'.format(shot)] = numpy.NaN
             self.stats['Y{}'.format(shot)] = numpy.NaN
 
+        if self.parameters['siteReadout']['enable']:
+            self.site_readout(data, shot)
+
+    def track_drift(self, data, shot):
+        """Report the shift against the shot's reference frame.
+
+        DX<shot>/DY<shot> are the shift in um in the atom plane, X/Y the
+        reference position moved by that shift.
+        """
+        dy, dx = self.drift_trackers[shot].shift(data)
+        conv = self.conversion(shot)
+        reference_X, reference_Y = self.drift_reference[shot]
+        self.stats['DX{}'.format(shot)] = conv * dx
+        self.stats['DY{}'.format(shot)] = conv * dy
+        self.stats['X{}'.format(shot)] = reference_X + conv * dx
+        self.stats['Y{}'.format(shot)] = reference_Y + conv * dy
+
+    def warm_fit(self, fit, data_1d, COM, guesses, key):
+        """Run `fit`, seeded from the last converged parameters for `key`.
+
+        The cached parameters are used with a bounded evaluation budget as
+        long as the centroid stays within maxShift of where they were
+        found. If the warm fit fails or its result jumps by more than
+        maxShift, the cache entry is dropped and the fit is redone from the
+        cold guesses.
+
+        @return (fitted value, error, function evaluations)
+        """
+        settings = self.parameters['warmStart']
+        nfev = 0
+        cached = self.fit_cache.get(key) if settings['enable'] else None
+        if cached is not None and abs(COM - cached['COM']) <= settings['maxShift']:
+            value, error, params, n = fit(data_1d, COM, cached['params'], settings['maxfev'])
+            nfev += n
+            if (error == 0 and numpy.isfinite(value) and
+                    abs(value - cached['value']) <= settings['maxShift']):
+                self.fit_cache[key] = {'COM': COM, 'value': value, 'params': params}
+                return value, error, nfev
+        self.fit_cache.pop(key, None)
+        value, error, params, n = fit(data_1d, COM, guesses(data_1d, COM))
+        nfev += n
+        if settings['enable'] and error == 0 and numpy.isfinite(value):
+            self.fit_cache[key] = {'COM': COM, 'value': value, 'params': params}
+        return value, error, nfev
+
+    def site_readout(self, data, shot):
+        """Add per-site intensities (SITES<shot>) and occupancy (OCC<shot>).
+
+        The weights are positioned on the last good fit for this shot and are
+        only rebuilt when that fit moves by more than `tolerance` pixels or
+        the frame shape changes, so a frame costs one matrix product.
+        """
+        settings = self.parameters['siteReadout']
+        num_sites = settings['numSites']
+        if shot not in self.site_geometry:
+            self.stats['SITES{}'.format(shot)] = [numpy.NaN] * num_sites
+            self.stats['OCC{}'.format(shot)] = [0] * num_sites
+            return
+        x0, y0 = self.site_geometry[shot]
+        site_filter = self.site_filters.get(shot)
+        if site_filter is None or not site_filter.matches(data.shape, x0, y0, settings):
+            site_filter = SiteFilter(data.shape, x0, y0, settings)
+            self.site_filters[shot] = site_filter
+        intensities = site_filter.readout(data)
+        occupied = intensities > settings['occupancyThreshold']
+        self.stats['SITES{}'.format(shot)] = [float(i) for i in intensities]
+        self.stats['OCC{}'.format(shot)] = [int(o) for o in occupied]
+
+    def image_to_array(self, image, buffer_name=None):
+        """Copy a PyCapture2 image into a 2d uint8 array.
+
+        With `buffer_name` the copy goes into that workspace buffer instead
+        of a newly allocated array.
+        """
+        self.nrows = PyCapture2.Image.getRows(image)
+        self.ncols = PyCapture2.Image.getCols(image)
+        if buffer_name is None:
+            # retrieves raw image data from the camera buffer
+            raw_image_data = numpy.array(image.getData(), dtype=numpy.uint8)
+            # reshapes the data into a 2d array
+            return numpy.reshape(raw_image_data, (self.nrows, self.ncols), 'C')
+        data = self.workspace.get(buffer_name, numpy.uint8, (self.nrows, self.ncols))
+        data.reshape(-1)[...] = image.getData()
+        return data
+
     # Gets one image from the camera
     def GetImage(self):
             # Attempts to read an image from the camera buffer
         self.error = 0
         self.data = []
+        self.stamp = None
+        self.received = None
         try:
             shots = self.parameters['shotsPerMeasurement']
         except KeyError:
             shots = 1
+        start = time.time()
+        if self.parameters['pipelineShots'] and shots > 1:
+            self.GetImagePipelined(shots, start)
+        else:
+            self.GetImageSequential(shots, start)
+        if self.parameters['autoExposure']['enable']:
+            # the whole sequence is in, so a new exposure cannot split it
+            self.auto_expose(shots)
+        if self.parameters['autoROI']['enable']:
+            self.auto_roi()
+        self.record_result()
+        self.frames = (self.sequence, self.error, list(self.data))
+        return (self.error, self.data, self.stats)
+
+    def record_result(self):
+        """Append the finished measurement to the history ring."""
+        if self.history.maxlen != self.parameters['historyLength']:
+            self.history = collections.deque(
+                self.history,
+                self.parameters['historyLength']
+            )
+        self.sequence += 1
+        self.history.append({
+            'seq': self.sequence,
+            'time': time.time(),
+            'stamp': self.stamp,
+            'received': self.received,
+            'error': self.error,
+            'stats': dict(self.stats)
+        })
+
+    def last_frames(self):
+        """Return (seq, error, frames) of the last finished measurement.
+
+        Like results_since this clears nothing, so every viewer gets the
+        frames and the stats stay for GET_RESULTS. The frames live in
+        workspace buffers that the next GetImage overwrites.
+        """
+        return self.frames
+
+    def results_since(self, seq):
+        """Return the history entries newer than sequence number `seq`.
+
+        Unlike get_data this does not clear anything, so any number of
+        clients can follow the same camera. Entries that already dropped out
+        of the ring are simply missing; a client can spot that as a gap in
+        the sequence numbers.
+        """
+        newer = []
+        # walk back from the newest entry, the ring is ordered by seq
+        for entry in reversed(self.history):
+            if entry['seq'] <= seq:
+                break
+            newer.append(entry)
+        newer.reverse()
+        return newer
+
+    def GetImageSequential(self, shots, start):
+        """Read out and analyse the shots of a measurement one by one."""
         for shot in range(shots):
             #print "Delta t:{} ms. Starting to take shot:{}".format(int(1000*(time.time()-self.start_time)), shot)
+            allocations = self.workspace.allocations
             try:
-                image = self.camera_instance.retrieveBuffer()
+                reshaped_image_data = self.retrieve_frame('frame{}'.format(shot))
                 #print "buffer retrieved"
-
-                # retrieves raw image data from the camera buffer
-                raw_image_data = numpy.array(image.getData(), dtype=numpy.uint8)
-                self.nrows = PyCapture2.Image.getRows(image)
-                self.ncols = PyCapture2.Image.getCols(image)
-                # reshapes the data into a 2d array
-                reshaped_image_data = numpy.reshape(
-                    raw_image_data,
-                    (self.nrows, self.ncols),
-                    'C'
+                retrieved = time.time()
+                if reshaped_image_data is None:
+                    self.shot_failed(shot)
+                    continue
+                self.analyse_shot(
+                    reshaped_image_data,
+                    shot,
+                    start,
+                    retrieved,
+                    allocations
                 )
-                self.calculate_statistics(reshaped_image_data, shot)
+                # move the shots that arrived during the analysis to host
+                # memory, so the rest of the burst finds free driver buffers
+                queued = shot + 1 + len(self.frame_queue)
+                self.drain_buffer(queued, shots - queued)
             except PyCapture2.Fc2error as fc2Err:
                 print fc2Err
-                print "Error occured. statistics for this shot will be set to NaN"
-                self.stats['X{}'.format(shot)] = numpy.NaN
-                self.stats['Y{}'.format(shot)] = numpy.NaN
-                self.stats['EV{}'.format(shot)] = numpy.NaN
-                self.error=1
+                self.shot_failed(shot)
                 #return (1, "Error", {})
         #print self.stats
         return (self.error, self.data, self.stats)
 
-    def get_data(self):
-        data = self.data
+    def GetImagePipelined(self, shots, start):
+        """GetImage variant that overlaps readout and analysis.
+
+        Each shot is copied out of the camera buffer as soon as it arrives and
+        queued for a worker thread, so a slow analysis of shot 0 cannot make
+        us miss shot 1. The worker handles shots strictly in order, so the
+        stats are assembled exactly as in the sequential loop.
+        """
+        pending = Queue.Queue()
+        worker = threading.Thread(
+            target=self.analysis_worker,
+            args=(pending, start)
+        )
+        self.worker_exc_info = None
+        worker.start()
+        try:
+            for shot in range(shots):
+                allocations = self.workspace.allocations
+                try:
+                    data = self.retrieve_frame('frame{}'.format(shot))
+                except PyCapture2.Fc2error as fc2Err:
+                    print fc2Err
+                    data = None
+                pending.put((shot, data, time.time(), allocations))
+        finally:
+            pending.put(None)
+            worker.join()
+        if self.worker_exc_info is not None:
+            # re-raise analysis errors just like the sequential loop would
+            exc_info = self.worker_exc_info
+            self.worker_exc_info = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return (self.error, self.data, self.stats)
+
+    def auto_expose(self, shots):
+        """Feed this measurement's EVs to the exposure controller.
+
+        The brightest shot is used so that no shot of the sequence saturates.
+        If the controller proposes a new exposure time it is written to the
+        camera right away, between sequences.
+        """
+        settings = self.parameters['autoExposure']
+        try:
+            controller = self.exposure_controller
+        except AttributeError:
+            controller = ExposureController(settings)
+            self.exposure_controller = controller
+        controller.settings = settings
+        EVs = [self.stats.get('EV{}'.format(shot), numpy.NaN) for shot in range(shots)]
+        EVs = [ev for ev in EVs if not numpy.isnan(ev)]
+        if not EVs:
+            return
+        exposureTime = controller.update(self.parameters['exposureTime'], max(EVs))
+        if exposureTime is not None:
+            self.parameters['exposureTime'] = exposureTime
+            self.SetExposureTime(exposureTime)
+        self.stats['EXPOSURE'] = self.parameters['exposureTime']
+
+    def retrieve_frame(self, buffer_name):
+        """Return the next frame, from frame_queue if one is queued.
+
+        The camera timestamp of the first frame of a measurement is kept in
+        `stamp`, the host time it left the driver in `received`. A queued
+        frame that failed to read out is returned as None.
+
+        Queued frames are copied into `buffer_name` as well, so the queue
+        buffers are free for the next measurement while GET_IMAGE still
+        serves this one.
+        """
+        if self.frame_queue:
+            queued, stamp, received = self.frame_queue.popleft()
+            data = None
+            if queued is not None:
+                data = self.workspace.get(buffer_name, queued.dtype, queued.shape)
+                data[...] = queued
+        else:
+            image = self.camera_instance.retrieveBuffer()
+            received = time.time()
+            data = self.image_to_array(image, buffer_name)
+            stamp = image_stamp(image)
+        if self.stamp is None and stamp is not None:
+            self.stamp = stamp
+            self.received = received
+        return data
+
+    def frame_entry(self, image, shot):
+        """Copy a retrieved image into a (frame, stamp, host time) entry.
+
+        The frame goes into the workspace buffer queued<shot>.
+        """
+        received = time.time()
+        data = self.image_to_array(image, 'queued{}'.format(shot))
+        return (data, image_stamp(image), received)
+
+    def queue_frame(self, image, shot):
+        """Copy a retrieved image to frame_queue with its stamp and host time."""
+        self.frame_queue.append(self.frame_entry(image, shot))
+
+    def drain_buffer(self, shot, limit):
+        """Copy up to `limit` frames waiting in the driver buffers to frame_queue.
+
+        Only meaningful in 'buffer' grab mode. Moving frames to host memory
+        frees the driver buffers, so a burst of shots is not lost to buffer
+        overflow while a slow analysis catches up. `limit` is the number of
+        shots the measurement still misses, starting with `shot`; frames
+        beyond it belong to the next trigger and stay in the driver.
+
+        @return the number of frames drained
+        """
+        if self.parameters['grabMode'] != 'buffer' or limit <= 0:
+            return 0
+        config = self.camera_instance.getConfiguration()
+        self.camera_instance.setConfiguration(grabTimeout=0)
+        drained = 0
+        try:
+            # bounded, in case frames arrive as fast as we drain them
+            for i in range(min(limit, self.parameters['numBuffers'])):
+                try:
+                    image = self.camera_instance.retrieveBuffer()
+                except PyCapture2.Fc2error:
+                    break  # timed out, the driver buffers are empty
+                self.queue_frame(image, shot + drained)
+                drained += 1
+        finally:
+            self.camera_instance.setConfiguration(grabTimeout=config.grabTimeout)
+        self.frames_drained += drained
+        return drained
+
+    def buffer_occupancy(self):
+        """Report the grab mode and the host side frame queue."""
+        return {
+            'grabMode': self.parameters['grabMode'],
+            'numBuffers': self.parameters['numBuffers'],
+            'queued': len(self.frame_queue),
+            'drained': self.frames_drained
+        }
+
+    def analysis_worker(self, pending, start):
+        """Analyse queued shots in order until a None sentinel arrives."""
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            if self.worker_exc_info is not None:
+                continue  # drain the queue after a failure
+            shot, data, retrieved, allocations = item
+            try:
+                if data is None:
+                    self.shot_failed(shot)
+                else:
+                    self.analyse_shot(data, shot, start, retrieved, allocations)
+            except:
+                self.worker_exc_info = sys.exc_info()
+
+    def analyse_shot(self, data, shot, start, retrieved, allocations):
+        """Run calculate_statistics on one shot and record its timing."""
+        analysis_start = time.time()
+        self.calculate_statistics(data, shot)
+        # keep the frame as analysed (defects patched, background removed)
+        # for GET_IMAGE; it lives in a workspace buffer until the next GetImage
+        self.data.append(data)
+        # TR: ms from the start of the measurement until the shot was read out
+        # TA: ms spent analysing the shot
+        self.stats['TR{}'.format(shot)] = 1000 * (retrieved - start)
+        self.stats['TA{}'.format(shot)] = 1000 * (time.time() - analysis_start)
+        if self.parameters['debugAllocations']:
+            allocations = self.workspace.allocations - allocations
+            self.stats['ALLOC{}'.format(shot)] = allocations
+
+    def shot_failed(self, shot):
+        """Set the statistics for a shot that could not be read out to NaN."""
+        print "Error occured. statistics for this shot will be set to NaN"
+        self.stats['X{}'.format(shot)] = numpy.NaN
+        self.stats['Y{}'.format(shot)] = numpy.NaN
+        self.stats['EV{}'.format(shot)] = numpy.NaN
+        self.error=1
+
+    def get_data(self, frames=True):
+        """Return (error, frames, stats) of the last measurement and clear them.
+
+        With frames=False the frames are left alone, GET_IMAGE serves them
+        through last_frames, and an empty list is returned in their place.
+        """
+        if not frames:
+            data = []
+        else:
+            data = self.data
+            self.data = []
         error = self.error
         stats = self.stats
-        # clear data and error
-        self.data = []
+        # clear error and stats
         self.error = 0
         self.stats = {}
         return (error, data, stats)
@@ -343,11 +1152,26 @@ class BlackflyCamera(object):
         self.camera_instance.writeRegister(cameraPower, powerVal)
         return
 
+    def prepare_capture(self):
+        """Write the settings that can only change while the camera is idle.
+
+        start_capture calls this too; the server calls it first for every
+        camera so it can plan the bandwidth for the new frame sizes.
+        """
+        if self.pending_roi is not None:
+            # a window chosen by auto_roi
+            self.apply_roi(self.pending_roi)
+        # a grab mode sent while the camera streamed
+        self.SetGrabMode(self.parameters['grabMode'], self.parameters['numBuffers'])
+
     def start_capture(self):
         """Software trigger to begin capturing an image."""
         # callback function causes server to crash
         # self.camera_instance.startCapture(print_image_info)
+        self.prepare_capture()
         self.camera_instance.startCapture()
+        # frames drained during a previous measurement are stale now
+        self.frame_queue.clear()
         self.status = 'ACQUIRING'
         self.start_time = time.time()
 
@@ -366,6 +1190,624 @@ class BlackflyCamera(object):
         except:
             print "exception 2"
 
+class ExposureController(object):
+    """Steer the exposure value (EV) of a camera into a target band.
+
+    EV, the 10th brightest pixel, is modelled as dark + gain * t, where t is
+    the exposure time the shutter register produces (see
+    shutter_to_exposure). dark and gain are fitted to the recent unsaturated
+    history, so an unsaturated shot is usually brought into the band by the
+    next write. Saturated or dark shots carry no gain information and step
+    the exposure by a fixed factor instead.
+
+    The shutter's nonlinearity is not modelled: t comes from the linear
+    register fit, and minExposure/maxExposure keep the controller inside
+    the register range where that fit was calibrated.
+    """
+
+    step = 4.0  # exposure factor applied to saturated or dark shots
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.history = collections.deque(maxlen=settings['history'])
+        self.last_write = 0
+
+    def model(self):
+        """Return (dark, gain) for the unsaturated history."""
+        dark = self.settings['darkLevel']
+        points = [(t, ev) for t, ev in self.history if dark < ev < 255]
+        if len(set(t for t, ev in points)) >= 2:
+            gain, fitted_dark = numpy.polyfit(
+                [t for t, ev in points],
+                [ev for t, ev in points],
+                1
+            )
+            if gain > 0:
+                return fitted_dark, gain
+        t, ev = points[-1]
+        return dark, (ev - dark) / t
+
+    def update(self, exposureTime, EV):
+        """Record a measurement and return a new exposure time in ms.
+
+        Returns None if EV is already in band, the exposure cannot change or
+        the last write was less than minInterval ago.
+        """
+        settings = self.settings
+        if self.history.maxlen != settings['history']:
+            self.history = collections.deque(self.history, settings['history'])
+        t = shutter_to_exposure(exposure_to_shutter(exposureTime))
+        self.history.append((t, EV))
+        if settings['targetLow'] <= EV <= settings['targetHigh']:
+            return None
+        if time.time() - self.last_write < settings['minInterval']:
+            return None
+        if EV >= 255:
+            new_t = t / self.step
+        elif EV <= settings['darkLevel']:
+            new_t = t * self.step
+        else:
+            dark, gain = self.model()
+            target = 0.5 * (settings['targetLow'] + settings['targetHigh'])
+            new_t = (target - dark) / gain
+        new_t = min(max(new_t, settings['minExposure']), settings['maxExposure'])
+        if exposure_to_shutter(new_t) == exposure_to_shutter(t):
+            return None
+        self.last_write = time.time()
+        return new_t
+
+class AnalysisWorkspace(object):
+    """Named, preallocated frame-sized buffers for one camera.
+
+    Buffers are created on first use and kept until the ROI changes. Every
+    frame-sized array on the path of a shot (read-out and queued frames, the
+    histogram scratch, the threshold and opening masks) comes from here, so
+    in steady state a shot allocates only arrays the size of its signal.
+    `allocations` counts every buffer that had to be (re)created, so a
+    nonzero ALLOC<shot> marks the shots that paid for a new ROI.
+    """
+
+    def __init__(self):
+        self.shape = None
+        self.allocations = 0
+        self._buffers = {}
+
+    def resize(self, shape):
+        """Drop all buffers if the frame shape changed."""
+        shape = tuple(shape)
+        if shape != self.shape:
+            self.shape = shape
+            self._buffers = {}
+
+    def get(self, name, dtype, shape=None):
+        """Return the buffer `name`, allocating it if needed."""
+        if shape is None:
+            shape = self.shape
+        shape = tuple(shape)
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = numpy.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+            self.allocations += 1
+        return buf
+
+class BackgroundModel(object):
+    """Per-pixel exponential moving average of the camera background.
+
+    Replaces a full-frame median: each update costs a constant number of
+    operations per pixel and all work is done in preallocated buffers.
+    """
+
+    def __init__(self, alpha=0.05, gate_level=40):
+        self.alpha = alpha
+        self.gate_level = gate_level
+        self.reset()
+
+    def reset(self):
+        """Forget the learned background."""
+        self.model = None
+        self.model_u8 = None
+        self.num_updates = 0
+
+    def update(self, data):
+        """Fold a signal-free frame into the model: m += alpha*(data - m)."""
+        if self.model is None or self.model.shape != data.shape:
+            # first frame (or new ROI): seed the model directly
+            self.model = data.astype(numpy.float32)
+            self._scratch = numpy.empty(data.shape, dtype=numpy.float32)
+            self._scratch_u8 = numpy.empty(data.shape, dtype=numpy.uint8)
+            self.model_u8 = numpy.empty(data.shape, dtype=numpy.uint8)
+        else:
+            self.model *= (1.0 - self.alpha)
+            self._scratch[...] = data
+            self._scratch *= self.alpha
+            self.model += self._scratch
+        # keep a rounded uint8 copy so subtraction stays in the image dtype
+        numpy.rint(self.model, out=self._scratch)
+        self.model_u8[...] = self._scratch
+        self.num_updates += 1
+
+    def subtract(self, data):
+        """Subtract the model from data in place, clipping at zero."""
+        if self.model is None or self.model.shape != data.shape:
+            return data
+        numpy.minimum(data, self.model_u8, out=self._scratch_u8)
+        numpy.subtract(data, self._scratch_u8, out=data)
+        return data
+
+class DefectMap(object):
+    """Static hot pixel map for one camera serial and ROI.
+
+    Built once from a run of dark frames and cached on disk as an .npz file
+    per serial. The file holds sensor coordinates, so any ROI (e.g. one
+    chosen by auto_roi) gets its map by cropping the calibrated area. In
+    memory the bad pixels are flat indices into the ROI, stored together
+    with the flat indices of their good 4-neighbors, so correcting a frame
+    is a pair of small fancy indexing operations instead of a full-frame
+    morphological filter.
+    """
+
+    def __init__(self, serial, roi, shape, bad_pixels):
+        self.serial = serial
+        self.roi = tuple(int(v) for v in roi)
+        self.shape = tuple(int(v) for v in shape)
+        self.bad_pixels = numpy.asarray(bad_pixels, dtype=numpy.intp)
+        self._build_neighbors()
+
+    def _build_neighbors(self):
+        """Precompute neighbor indices and weights for interpolation."""
+        nrows, ncols = self.shape
+        rows, cols = numpy.unravel_index(self.bad_pixels, self.shape)
+        bad = numpy.zeros(self.shape, dtype=bool)
+        bad[rows, cols] = True
+        self.neighbors = numpy.zeros((len(self.bad_pixels), 4), dtype=numpy.intp)
+        self.weights = numpy.zeros((len(self.bad_pixels), 4), dtype=numpy.float32)
+        for i, (dr, dc) in enumerate([(-1, 0), (1, 0), (0, -1), (0, 1)]):
+            r = numpy.clip(rows + dr, 0, nrows - 1)
+            c = numpy.clip(cols + dc, 0, ncols - 1)
+            valid = (r == rows + dr) & (c == cols + dc) & ~bad[r, c]
+            self.neighbors[:, i] = r * ncols + c
+            self.weights[:, i] = valid
+        total = self.weights.sum(axis=1)
+        # pixels with no good neighbor are simply zeroed
+        self.weights[total > 0] /= total[total > 0, numpy.newaxis]
+
+    @classmethod
+    def from_dark_frames(cls, serial, roi, frames, n_sigma=6.0):
+        """Flag pixels whose dark level is an outlier of the frame average."""
+        mean = numpy.zeros(numpy.shape(frames[0]), dtype=numpy.float64)
+        for frame in frames:
+            mean += frame
+        mean /= len(frames)
+        median = numpy.median(mean)
+        # robust noise estimate, floored at one count for quiet 8 bit sensors
+        mad = max(1.4826 * numpy.median(numpy.absolute(mean - median)), 1.0)
+        bad_pixels = numpy.flatnonzero(mean > median + n_sigma * mad)
+        return cls(serial, roi, mean.shape, bad_pixels)
+
+    @staticmethod
+    def filename(directory, serial):
+        return os.path.join(directory, 'defects_{}.npz'.format(serial))
+
+    @classmethod
+    def load(cls, directory, serial, roi):
+        """Return the cached map for serial cropped to ROI, or None if absent."""
+        path = cls.filename(directory, serial)
+        if not os.path.isfile(path):
+            return None
+        cached = numpy.load(path)
+        return cls.crop(serial, roi, cached['rows'], cached['cols'])
+
+    @classmethod
+    def crop(cls, serial, roi, rows, cols):
+        """Map for ROI (offsetX, offsetY, width, height) from sensor pixels."""
+        offsetX, offsetY, width, height = roi
+        rows = numpy.asarray(rows, dtype=numpy.intp) - offsetY
+        cols = numpy.asarray(cols, dtype=numpy.intp) - offsetX
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        return cls(serial, roi, (height, width), rows[inside] * width + cols[inside])
+
+    def sensor_pixels(self):
+        """Return the (rows, cols) of the bad pixels on the sensor."""
+        rows, cols = numpy.unravel_index(self.bad_pixels, self.shape)
+        return rows + self.roi[1], cols + self.roi[0]
+
+    def save(self, directory):
+        """Merge this map into the serial's cached map.
+
+        Pixels inside this ROI are replaced by this calibration, those
+        outside keep what earlier calibrations found.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = self.filename(directory, self.serial)
+        rows, cols = self.sensor_pixels()
+        if os.path.isfile(path):
+            cached = numpy.load(path)
+            offsetX, offsetY, width, height = self.roi
+            old_rows, old_cols = cached['rows'], cached['cols']
+            outside = ~((old_rows >= offsetY) & (old_rows < offsetY + height) &
+                        (old_cols >= offsetX) & (old_cols < offsetX + width))
+            rows = numpy.concatenate([old_rows[outside], rows])
+            cols = numpy.concatenate([old_cols[outside], cols])
+        numpy.savez(path, rows=rows, cols=cols)
+
+    def apply(self, data, mode='interpolate'):
+        """Correct the bad pixels of data in place."""
+        if data.shape != self.shape or len(self.bad_pixels) == 0:
+            return data
+        if mode == 'mask':
+            data.flat[self.bad_pixels] = 0
+        else:
+            values = (data.flat[self.neighbors] * self.weights).sum(axis=1)
+            data.flat[self.bad_pixels] = numpy.rint(values)
+        return data
+
+def opening_in_roi(mask, out=None):
+    """binary_opening restricted to the bounding box of the set pixels.
+
+    Identical to opening the full frame (pixels outside the box are False and
+    scipy pads with False), but only touches the region holding signal. The
+    result goes into `out` if given.
+    """
+    if out is None:
+        out = numpy.empty_like(mask)
+    out[...] = False
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return out
+    cols = numpy.flatnonzero(mask.any(axis=0))
+    roi = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+    out[roi] = binary_opening(mask[roi])
+    return out
+
+class DriftTracker(object):
+    """Subpixel shift of a frame region against a reference frame.
+
+    The shift is the peak of the FFT cross-correlation of the mean-subtracted
+    regions, refined with a parabola through its neighbors. The spectrum is
+    deliberately not whitened: for spots a few tens of pixels wide nearly
+    every frequency bin is noise, which pure phase correlation would weight
+    equally with the signal. A tapering window is not used either, since it
+    pulls the estimate towards the region center. The conjugate reference
+    spectrum is computed once, and the region size never changes, so
+    numpy's FFT reuses its cached plan for every frame.
+    """
+
+    def __init__(self, data, center, size):
+        nrows, ncols = data.shape
+        h, w = min(size[0], nrows), min(size[1], ncols)
+        r1 = min(max(int(round(center[0])) - h // 2, 0), nrows - h)
+        c1 = min(max(int(round(center[1])) - w // 2, 0), ncols - w)
+        self.window = (slice(r1, r1 + h), slice(c1, c1 + w))
+        self._region = numpy.empty((h, w))
+        self.reference = numpy.conj(numpy.fft.rfft2(self._centered(data)))
+
+    def _centered(self, data):
+        self._region[...] = data[self.window]
+        self._region -= self._region.mean()
+        return self._region
+
+    def shift(self, data):
+        """Return the (row, col) shift of data relative to the reference."""
+        spectrum = numpy.fft.rfft2(self._centered(data))
+        spectrum *= self.reference
+        corr = numpy.fft.irfft2(spectrum, s=self._region.shape)
+        peak = numpy.unravel_index(numpy.argmax(corr), corr.shape)
+        shift = []
+        for axis, p in enumerate(peak):
+            n = corr.shape[axis]
+            index = list(peak)
+            index[axis] = (p - 1) % n
+            before = corr[tuple(index)]
+            index[axis] = (p + 1) % n
+            after = corr[tuple(index)]
+            # parabola through the peak and its neighbors
+            denom = before - 2 * corr[peak] + after
+            delta = 0.5 * (before - after) / denom if denom != 0 else 0.0
+            s = p + delta
+            if s > n / 2.0:
+                s -= n  # shifts past half the region wrap around
+            shift.append(s)
+        return tuple(shift)
+
+class SiteFilter(object):
+    """Matched-filter weights for a row of lattice sites.
+
+    Each site is modelled as a 2d gaussian over a window covering all
+    sites. The weights are the pseudo-inverse of those profiles plus a
+    constant, so a spot of peak height A on site k reads out as A even
+    though neighboring sites overlap, and a uniform background reads out as
+    zero on every site. All sites are read out with a single matrix product.
+    """
+
+    def __init__(self, shape, x0, y0, settings):
+        self.shape = shape
+        self.x0 = x0
+        self.y0 = y0
+        self.settings = dict(settings)
+        num_sites = settings['numSites']
+        sigma_x = float(settings['sigmaX'])
+        sigma_y = float(settings['sigmaY'])
+        centers = x0 + settings['spacing'] * (numpy.arange(num_sites) - (num_sites - 1) / 2.0)
+        # +-3 sigma around the outermost sites, clipped to the frame
+        c1 = min(max(int(numpy.floor(centers.min() - 3 * sigma_x)), 0), shape[1])
+        c2 = min(max(int(numpy.ceil(centers.max() + 3 * sigma_x)) + 1, c1), shape[1])
+        r1 = min(max(int(numpy.floor(y0 - 3 * sigma_y)), 0), shape[0])
+        r2 = min(max(int(numpy.ceil(y0 + 3 * sigma_y)) + 1, r1), shape[0])
+        self.window = (slice(r1, r2), slice(c1, c2))
+        cols = numpy.arange(c1, c2)
+        gy = numpy.exp(-(numpy.arange(r1, r2) - y0)**2 / (2 * sigma_y**2))
+        # the last column takes up the background level of the window
+        profiles = numpy.ones(((r2 - r1) * (c2 - c1), num_sites + 1))
+        for k, xc in enumerate(centers):
+            gx = numpy.exp(-(cols - xc)**2 / (2 * sigma_x**2))
+            profiles[:, k] = numpy.outer(gy, gx).ravel()
+        self.weights = numpy.linalg.pinv(profiles)[:num_sites]
+
+    def matches(self, shape, x0, y0, settings):
+        """True if these weights are still valid for the given geometry."""
+        tolerance = settings['tolerance']
+        return (shape == self.shape and
+                settings == self.settings and
+                abs(x0 - self.x0) <= tolerance and
+                abs(y0 - self.y0) <= tolerance)
+
+    def readout(self, data):
+        """Return the intensity of each site in data."""
+        return self.weights.dot(data[self.window].ravel())
+
+class SiteClassifier(object):
+    """Tell the ground laser from the FORT by its lattice neighbors.
+
+    The ground laser has bright sites above and below the centroid, the FORT
+    only along the row. One summed-area table is built per frame (into a
+    buffer that is reused), after which every candidate window sum is four
+    lookups. Meant for thresholded frames, where every pixel is either 0 or
+    above threshold, so a nonzero window sum means the site is bright.
+    """
+
+    verts = [(0, 1), (0, -1)]
+    horiz = [(-2, 0), (-1, 0), (1, 0), (2, 0)]
+
+    def __init__(self, spacing=42, half_width=15, half_height=15):
+        self.spacing = spacing
+        self.half_width = half_width
+        self.half_height = half_height
+        self.table = None
+
+    def build(self, data):
+        """Fill the summed-area table; table[i, j] = data[:i, :j].sum()."""
+        shape = (data.shape[0] + 1, data.shape[1] + 1)
+        if self.table is None or self.table.shape != shape:
+            # the first row and column stay zero
+            self.table = numpy.zeros(shape, dtype=numpy.float64)
+        inner = self.table[1:, 1:]
+        numpy.cumsum(data, axis=0, dtype=numpy.float64, out=inner)
+        numpy.cumsum(inner, axis=1, out=inner)
+
+    def window_sum(self, x1, x2, y1, y2):
+        """Sum of data[x1:x2, y1:y2], clipped to the frame."""
+        nx, ny = self.table.shape
+        x1, x2 = min(max(x1, 0), nx - 1), min(max(x2, 0), nx - 1)
+        y1, y2 = min(max(y1, 0), ny - 1), min(max(y2, 0), ny - 1)
+        if x2 <= x1 or y2 <= y1:
+            return 0.0
+        t = self.table
+        return float(t[x2, y2] - t[x1, y2] - t[x2, y1] + t[x1, y1])
+
+    def site_sums(self, offsets, COM_X, COM_Y):
+        sums = []
+        for dx, dy in offsets:
+            X = dx * self.spacing + int(COM_X)
+            Y = dy * self.spacing + int(COM_Y)
+            sums.append(self.window_sum(
+                X - self.half_height, X + self.half_height,
+                Y - self.half_width, Y + self.half_width
+            ))
+        return sums
+
+    def classify(self, data, COM_X, COM_Y):
+        """Return the ground/FORT decision and the neighbor window sums."""
+        self.build(data)
+        vertical = self.site_sums(self.verts, COM_X, COM_Y)
+        horizontal = self.site_sums(self.horiz, COM_X, COM_Y)
+        return {
+            'ground': any(v > 0 for v in vertical),
+            'vertical': vertical,
+            'horizontal': horizontal
+        }
+
+def merge_parameters(parameters, updates):
+    """Copy updates into parameters, merging nested dicts key by key.
+
+    A client can send part of an option dict, e.g. {'autoROI': {'enable':
+    True}}, and the keys it leaves out keep their current values. Merged
+    dicts are copies, so neither side is changed through the other later.
+    """
+    for key in updates:
+        value = updates[key]
+        current = parameters.get(key)
+        if isinstance(current, dict) and isinstance(value, dict):
+            merged = dict(current)
+            merge_parameters(merged, value)
+            parameters[key] = merged
+        else:
+            parameters[key] = value
+
+def image_stamp(image):
+    """Camera timestamp of a PyCapture2 image in seconds."""
+    stamp = image.getTimeStamp()
+    return stamp.seconds + 1e-6 * stamp.microSeconds
+
+def is_timeout(fc2Err):
+    """True if a PyCapture2 error only says no frame arrived in time.
+
+    PyCapture2 raises every driver error as Fc2error and only its message
+    tells them apart, e.g. 'Timeout error.' for FC2_ERROR_TIMEOUT.
+    """
+    return 'timeout' in str(fc2Err).lower()
+
+def bytes_per_pixel(pixel_format):
+    """Bytes per pixel on the wire for a PyCapture2.PIXEL_FORMAT value.
+
+    Unknown or missing formats count as mono8.
+    """
+    sizes = (
+        ('MONO8', 1), ('RAW8', 1), ('MONO12', 1.5), ('RAW12', 1.5),
+        ('MONO16', 2), ('RAW16', 2), ('S_MONO16', 2), ('422YUV8', 2),
+        ('411YUV8', 1.5), ('444YUV8', 3), ('RGB8', 3), ('BGR', 3)
+    )
+    for name, size in sizes:
+        if getattr(PyCapture2.PIXEL_FORMAT, name, None) == pixel_format:
+            return size
+    return 1
+
+def stream_settings_filename(directory, serial, nic):
+    return os.path.join(directory, 'stream_{}_{}.json'.format(serial, nic))
+
+def load_stream_settings(directory, serial, nic):
+    """Return the saved stream settings for serial and NIC, or None."""
+    path = stream_settings_filename(directory, serial, nic)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_stream_settings(directory, serial, nic, stream):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(stream_settings_filename(directory, serial, nic), 'w') as f:
+        json.dump(stream, f)
+
+def aligned_roi(x, y, width, height, info):
+    """Window of at least width x height px around (x, y) the camera accepts.
+
+    Sizes are rounded up to the image step sizes and offsets down to the
+    offset step sizes of `info` (a GigEImageSettingsInfo); the window is
+    kept on the sensor.
+    """
+    width = min(align_up(width, info.imageHStepSize), info.maxWidth)
+    height = min(align_up(height, info.imageVStepSize), info.maxHeight)
+    offsetX = min(max(int(x - width / 2.0), 0), info.maxWidth - width)
+    offsetY = min(max(int(y - height / 2.0), 0), info.maxHeight - height)
+    return {
+        'offsetX': offsetX - offsetX % max(info.offsetHStepSize, 1),
+        'offsetY': offsetY - offsetY % max(info.offsetVStepSize, 1),
+        'width': width,
+        'height': height
+    }
+
+def align_up(value, step):
+    """Round value up to a multiple of step."""
+    step = max(int(step), 1)
+    return int(-(-value // step) * step)
+
+def exposure_to_shutter(exposureTime):
+    """Shutter register value for an exposure time in ms.
+
+    For values between 5 and 1000, shutter time is very well approximated
+    by: t = (shutter_value*18.81 - 22.08) us. The maximum value is 4095.
+    """
+    shutter_value = int(round((exposureTime*1000+22.08)/18.81))
+    return min(shutter_value, 4095)
+
+def shutter_to_exposure(shutter_value):
+    """Exposure time in ms produced by a shutter register value.
+
+    Uses the linear fit of exposure_to_shutter, which is only calibrated
+    for register values 5 to 1000. No measurement of the nonlinear response
+    above 1000 exists, so larger values are extrapolated. Below 1 the fit
+    gives zero or negative times, so values under 5 are clamped to 5.
+    """
+    shutter_value = max(shutter_value, 5)
+    return (shutter_value*18.81 - 22.08)/1000.0
+
+class SparseImage(object):
+    """Above-threshold pixels of a frame, as flat indices and values.
+
+    Stands in for the zero-filled frame the dense centroid path produces.
+    """
+
+    def __init__(self, flat, values, shape):
+        self.flat = flat
+        self.values = numpy.asarray(values, dtype=numpy.float64)
+        self.shape = shape
+
+    def __len__(self):
+        return len(self.flat)
+
+    def projection(self, axis):
+        """Same as numpy.sum(self.dense(), axis=axis)."""
+        rows, cols = numpy.unravel_index(self.flat, self.shape)
+        index = cols if axis == 0 else rows
+        return numpy.bincount(
+            index,
+            weights=self.values,
+            minlength=self.shape[1 - axis]
+        )
+
+    def center_of_mass(self):
+        """Intensity weighted (row, col) centroid."""
+        rows, cols = numpy.unravel_index(self.flat, self.shape)
+        total = self.values.sum()
+        return [numpy.dot(rows, self.values) / total,
+                numpy.dot(cols, self.values) / total]
+
+    def dense(self):
+        """Expand back to a full frame, for display or debugging only."""
+        data = numpy.zeros(self.shape, dtype=self.values.dtype)
+        data.flat[self.flat] = self.values
+        return data
+
+def projection(data, axis):
+    """Sum a dense frame or a SparseImage along axis."""
+    if isinstance(data, SparseImage):
+        return data.projection(axis)
+    return numpy.sum(data, axis=axis)
+
+def nth_largest_value(data, n, scratch=None):
+    """Return numpy.partition(data.flatten(), -n)[-n].
+
+    8 bit frames go through a 256 bin histogram, which avoids partially
+    sorting the whole frame. bincount only counts intp arrays and would
+    convert the frame to a new one; pass an intp `scratch` array of the
+    frame's size to have the conversion reuse it.
+    """
+    if data.dtype == numpy.uint8:
+        if scratch is None:
+            scratch = numpy.empty(data.shape, dtype=numpy.intp)
+        scratch[...] = data
+        counts = numpy.bincount(scratch.ravel(), minlength=256)
+        # at_least[v] is the number of pixels with value >= v
+        at_least = numpy.cumsum(counts[::-1])[::-1]
+        return data.dtype.type(numpy.flatnonzero(at_least >= n)[-1])
+    return numpy.partition(data.ravel(), -n)[-n]
+
+def _contains(sorted_values, queries):
+    """Elementwise membership test of queries in a sorted index array."""
+    pos = numpy.searchsorted(sorted_values, queries)
+    pos[pos == len(sorted_values)] = 0
+    return sorted_values[pos] == queries
+
+def sparse_opening(flat, shape):
+    """binary_opening with the default cross structure, on flat indices.
+
+    `flat` must be sorted, as returned by numpy.flatnonzero. Pixels outside
+    the frame count as unset, matching scipy's border handling.
+    """
+    nrows, ncols = shape
+    if len(flat) == 0:
+        return flat
+    rows, cols = numpy.divmod(flat, ncols)
+    # erosion: keep pixels whose four neighbors are all set
+    eroded = flat[(rows > 0) & (rows < nrows - 1) & (cols > 0) & (cols < ncols - 1)]
+    for step in (1, -1, ncols, -ncols):
+        eroded = eroded[_contains(flat, eroded + step)]
+    # dilation: eroded pixels are interior, so no bounds checks are needed
+    steps = (0, 1, -1, ncols, -ncols)
+    return numpy.unique(numpy.concatenate([eroded + step for step in steps]))
+
 # Five site gaussian function
 def quintuplegaussian(x, c1, mu1, sigma1,c2, mu2, sigma2,c3, mu3, sigma3,c4, mu4, sigma4,c5, mu5, sigma5, B):
     res = c1 * numpy.exp( - (x - mu1)**2.0 / (2.0 * sigma1**2.0) ) + c2 * numpy.exp( - (x - mu2)**2.0 / (2.0 * sigma2**2.0) ) + c3 * numpy.exp( - (x - mu3)**2.0 / (2.0 * sigma3**2.0) ) + c4 * numpy.exp( - (x - mu4)**2.0 / (2.0 * sigma4**2.0) ) + c5 * numpy.exp( - (x - mu5)**2.0 / (2.0 * sigma5**2.0) ) + B
@@ -391,23 +1833,56 @@ def img_crop(data,COM_X,COM_Y):
    else:
        return data, 0, 0
 
-def gaussianfit_x(data,COM_X):
+def fit_gaussian(leng,data_1d,guess,maxfev=0):
+    """curve_fit a single gaussian; returns (parameters, function evaluations).
+
+    maxfev=0 keeps the leastsq default budget. Raises RuntimeError if the
+    fit does not converge within the budget.
+    """
+    fit = curve_fit(gaussian,leng,data_1d,guess,full_output=True,maxfev=maxfev)
+    return fit[0], fit[2]['nfev']
+
+def x_guesses(data_1d,COM_X):
+    """Cold start guesses for the five sites around COM_X."""
+    [amp,bg] = [numpy.max(data_1d)-numpy.median(data_1d),numpy.median(data_1d)]
+    [site_separation,sigma]=[41,15]
+    # primary guess is fit3
+    return [[0.4*amp,COM_X-2*site_separation,sigma,bg],
+            [0.6*amp,COM_X-1*site_separation,sigma,bg],
+            [amp,COM_X,sigma,bg],
+            [0.6*amp,COM_X+1*site_separation,sigma,bg],
+            [0.4*amp,COM_X+2*site_separation,sigma,bg]]
+
+def y_guesses(data_1d,COM_Y):
+    """Cold start guess for the single gaussian along y."""
+    [maxx,bg] = [numpy.max(data_1d),numpy.min(data_1d)]
+    sigma=20
+    return [[maxx,COM_Y,sigma,bg]]
+
+def fit_sites_x(data_1d,COM_X,guesses,maxfev=0):
+    """Fit one gaussian per site guess and pick the brightest site.
+
+    @return (X, error, fitted parameters, function evaluations)
+    """
     error=0
     gaussian_X=numpy.NaN
-    data_1d=numpy.sum(data,axis=0) # check if the axis correctf
+    fits=None
+    nfev=0
     leng = range(0,len(data_1d))
-    [amp,bg] = [numpy.max(data_1d)-numpy.median(data_1d),numpy.median(data_1d)]
-    [site_separation,sigma]=[41,15]
     tolerance=15.0
     try:
-        # primary guess is fit3
-        fit1 = curve_fit(gaussian,leng,data_1d,[0.4*amp,COM_X-2*site_separation,sigma,bg])
-        fit2 = curve_fit(gaussian,leng,data_1d,[0.6*amp,COM_X-1*site_separation,sigma,bg])
-        fit3 = curve_fit(gaussian,leng,data_1d,[amp,COM_X,sigma,bg])
-        fit4 = curve_fit(gaussian,leng,data_1d,[0.6*amp,COM_X+1*site_separation,sigma,bg])
-        fit5 = curve_fit(gaussian,leng,data_1d,[0.4*amp,COM_X+2*site_separation,sigma,bg])
-        amps=[fit1[0][0],fit2[0][0],fit3[0][0],fit4[0][0],fit5[0][0]]
-        centers=[fit1[0][1],fit2[0][1],fit3[0][1],fit4[0][1],fit5[0][1]]
+        fits=[]
+        for guess in guesses:
+            try:
+                params, n = fit_gaussian(leng,data_1d,guess,maxfev)
+            except RuntimeError:
+                # a failed fit used up its whole budget
+                nfev+=maxfev or 200*(len(guess)+1)
+                raise
+            nfev+=n
+            fits.append(params)
+        amps=[fit[0] for fit in fits]
+        centers=[fit[1] for fit in fits]
         max_index=numpy.argmax(amps)
         X_candidate=centers[max_index]
         #print "COM_X:{}".format(COM_X)
@@ -416,19 +1891,27 @@ def gaussianfit_x(data,COM_X):
             gaussian_X=X_candidate
     except RuntimeError:
         error=1
+        fits=None
+    return gaussian_X, error, fits, nfev
 
-    return gaussian_X, error
+def fit_site_y(data_1d,COM_Y,guesses,maxfev=0):
+    """Fit a single gaussian along y.
 
-def gaussianfit_y(data,COM_Y):
-    error=0
-    data_1d=numpy.sum(data,axis=1) # check if the axis correctf
+    @return (Y, error, fitted parameters, function evaluations)
+    """
     leng = range(0,len(data_1d))
-    [maxx,bg] = [numpy.max(data_1d),numpy.min(data_1d)]
-    sigma=20
     try:
-        fit = curve_fit(gaussian,leng,data_1d,[maxx,COM_Y,sigma,bg])
-        gaussian_Y=fit[0][1]
+        params, nfev = fit_gaussian(leng,data_1d,guesses[0],maxfev)
+        return params[1], 0, [params], nfev
     except RuntimeError:
-        gaussian_Y=numpy.NaN
-        error=1
+        return numpy.NaN, 1, None, maxfev or 200*(len(guesses[0])+1)
+
+def gaussianfit_x(data,COM_X):
+    data_1d=projection(data,0) # check if the axis correctf
+    gaussian_X, error, fits, nfev = fit_sites_x(data_1d,COM_X,x_guesses(data_1d,COM_X))
+    return gaussian_X, error
+
+def gaussianfit_y(data,COM_Y):
+    data_1d=projection(data,1) # check if the axis correctf
+    gaussian_Y, error, fits, nfev = fit_site_y(data_1d,COM_Y,y_guesses(data_1d,COM_Y))
     return gaussian_Y, error
@@ -0,0 +1,99 @@
+"""Rb_blackfly_acquisition.py
+
+   Background acquisition for the Rb_blackfly viewers.
+
+   retrieveBuffer blocks for up to the grab timeout when no trigger arrives,
+   so the viewers grab and analyse frames in an AcquisitionThread and the Qt
+   event loop only draws the most recent result at a capped frame rate.
+   """
+
+import collections
+import threading
+import time
+import traceback
+
+import numpy as np
+import PyCapture2
+from pyqtgraph.Qt import QtCore
+
+
+def frame_from_image(image):
+    """Copy a PyCapture2 image into a 2d numpy array."""
+    nrows = PyCapture2.Image.getRows(image)   #finds the number of rows in the image data
+    ncols = PyCapture2.Image.getDataSize(image)/nrows   #finds the number of columns in the image data
+    return np.reshape(np.array(image.getData()), (nrows, ncols))
+
+
+class AcquisitionThread(QtCore.QThread):
+    """Producer thread: retrieve `shots` frames, analyse them, keep the result.
+
+    `analyse` is called with the list of frames and returns a dict. Only the
+    latest result is kept; a result replaced before the GUI took it counts
+    as dropped. A failed grab or analysis is printed and published as a
+    result whose 'error' is set, and the thread carries on with the next
+    frames.
+    """
+
+    def __init__(self, camera, analyse, shots=1, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.camera = camera
+        self.analyse = analyse
+        self.shots = shots
+        self.running = False
+        self.produced = 0
+        self.dropped = 0
+        self._latest = None
+        self._lock = threading.Lock()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            start = time.time()
+            try:
+                images = [self.camera.retrieveBuffer() for i in range(self.shots)]
+            except PyCapture2.Fc2error as fc2Err:
+                result = {'error': str(fc2Err)}
+            else:
+                acquired = time.time()
+                try:
+                    result = self.analyse([frame_from_image(i) for i in images])
+                except Exception as e:
+                    # a bad frame must not end the thread, the viewer would freeze
+                    traceback.print_exc()
+                    result = {'error': 'analysis failed: {}'.format(e)}
+                else:
+                    result['error'] = None
+                result['acquired'] = acquired
+                result['grab'] = acquired - start
+            with self._lock:
+                if self._latest is not None and self._latest['error'] is None:
+                    self.dropped += 1
+                self._latest = result
+                self.produced += 1
+
+    def take(self):
+        """Return the newest result and clear it, or None if there is none."""
+        with self._lock:
+            result = self._latest
+            self._latest = None
+        return result
+
+    def stop(self):
+        """Ask the producer to finish and wait for its last grab to return."""
+        self.running = False
+        self.wait()
+
+
+class FrameRateMeter(object):
+    """Frame rate over the last `window` redraws."""
+
+    def __init__(self, window=30):
+        self.times = collections.deque(maxlen=window)
+
+    def tick(self):
+        self.times.append(time.time())
+
+    def fps(self):
+        if len(self.times) < 2 or self.times[-1] == self.times[0]:
+            return 0.0
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
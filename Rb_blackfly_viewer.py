@@ -22,6 +22,8 @@
 #=============================================================================
 # For fitting
 import Rb_blackfly_image_gauss as fits
+from BlackflyCamera import BackgroundModel
+from Rb_blackfly_acquisition import AcquisitionThread, FrameRateMeter
 
 # For plotting
 from pyqtgraph.Qt import QtCore, QtGui
@@ -178,49 +180,54 @@ c.setConfiguration(grabTimeout = timeToWait)
 c.startCapture()
 
 imageNum = 0
-interval=5 # ms
+max_fps=30 # cap on redraws per second
+interval=int(1000/max_fps) # ms
 percentile=99.5
-def updateData():
-    try:
-        starttime=time.time()
-        image = c.retrieveBuffer()
-        latency=int(1000 * (time.time() - starttime))
-    except PyCapture2.Fc2error as fc2Err:
-        print "Error retrieving buffer : ", fc2Err
-        #text.setHtml("<font size=4>From {} <br /> "
-                         #"Error retrieving buffer: {}".format(str(cameraSerial),str(fc2Err)))
-        #image.save("test_images/MOT_image_{}.png".format(imageNum), 6) #if the directory does not exist, it will output an general failure error
-        #imageNum += 1
-        #the '6' indicates .png file format, see p. 99 of the PyCapture 2 manual for more info
-        ## Saves the data to an hdf5 file
-        #raw_image_data = PyCapture2.Image.getData(image)   #retrieves raw image data from the camera buffer
-    try:
-        nrows = PyCapture2.Image.getRows(image)   #finds the number of rows in the image data
-        ncols = PyCapture2.Image.getDataSize(image)/nrows   #finds the number of columns in the image data
-        #ncols = PyCapture2.Image.getCols(image)  #finds the number of columns in the image data
-        data=np.array(image.getData())
-        reshapeddata=np.reshape(data,(nrows,ncols))
-        baseline=np.median(data)
-        orienteddata=np.flip(reshapeddata.transpose(1,0),1)-baseline #subtract median baseline
-        img.setImage(orienteddata)
-        if int(np.max(orienteddata))>80:
-            #[COM_X,COM_Y]=fits.fort_gauss(orienteddata)['x'],fits.fort_gauss(orienteddata)['y']
-            #[COM_X,COM_Y]=scipy.ndimage.measurements.center_of_mass(orienteddata)
-            [COM_X,COM_Y]=np.unravel_index(np.argmax(orienteddata),orienteddata.shape) # locate maximum arg
-            scatter.setData(pos=[[COM_X,COM_Y]],size=10,symbol='o',brush=(255,0,0))
-            #print np.max(orienteddata)
-        else:
-            #[COM_X,COM_Y]=scipy.ndimage.measurements.center_of_mass(orienteddata)
-            [COM_X,COM_Y]=np.unravel_index(np.argmax(orienteddata),orienteddata.shape)
-            scatter.setData(pos=[[COM_X,COM_Y]],size=10,symbol='o',brush=(0,255,0))
-        text.setHtml("<font size=4>From {} <br /> "
-                         "Latency: {} ms, refresh time : {} ms <br/>"
-                         "Center X:{:.2f}, Y:{:.2f} <br/>"
-                         "{}th percentile: {}".format(str(cameraSerial), int(latency), int(interval), float(COM_X),float(COM_Y),float(percentile),int(np.percentile(orienteddata,percentile))))
-        QtCore.QTimer.singleShot(interval, updateData)
-    except:
+signal_level=80 # frames with a pixel above this are not used to learn the background
+background=BackgroundModel(alpha=0.05, gate_level=signal_level)
+
+def analyseFrames(frames):
+    # Runs on the acquisition thread, keep Qt calls out of here
+    reshapeddata=frames[0]
+    if np.max(reshapeddata)<background.gate_level:
+        background.update(reshapeddata) # only learn from signal-free frames
+    background.subtract(reshapeddata) # subtract per-pixel baseline in place
+    orienteddata=np.flip(reshapeddata.transpose(1,0),1)
+    #[COM_X,COM_Y]=fits.fort_gauss(orienteddata)['x'],fits.fort_gauss(orienteddata)['y']
+    #[COM_X,COM_Y]=scipy.ndimage.measurements.center_of_mass(orienteddata)
+    [COM_X,COM_Y]=np.unravel_index(np.argmax(orienteddata),orienteddata.shape) # locate maximum arg
+    return {
+        'image': orienteddata,
+        'COM': [COM_X,COM_Y],
+        'signal': int(np.max(orienteddata))>signal_level,
+        'percentile': int(np.percentile(orienteddata,percentile))
+    }
+
+acquisition=AcquisitionThread(c, analyseFrames)
+framerate=FrameRateMeter()
+
+def updateDisplay():
+    # Draws only the newest result, anything older was dropped by the producer
+    result=acquisition.take()
+    if result is None:
+        return
+    if result['error'] is not None:
+        #print "Error retrieving buffer : ", result['error']
         text.setHtml("<font size=4> No image to draw or could not retrive image from the camera")
-        QtCore.QTimer.singleShot(interval, updateData)
+        return
+    img.setImage(result['image'])
+    [COM_X,COM_Y]=result['COM']
+    if result['signal']:
+        scatter.setData(pos=[[COM_X,COM_Y]],size=10,symbol='o',brush=(255,0,0))
+    else:
+        scatter.setData(pos=[[COM_X,COM_Y]],size=10,symbol='o',brush=(0,255,0))
+    framerate.tick()
+    latency=1000*(time.time()-result['acquired']) # frame readout to screen
+    text.setHtml("<font size=4>From {} <br /> "
+                     "FPS: {:.1f}, dropped: {}, latency: {} ms, grab wait: {} ms <br/>"
+                     "Center X:{:.2f}, Y:{:.2f} <br/>"
+                     "{}th percentile: {}".format(str(cameraSerial), framerate.fps(), acquisition.dropped, int(latency), int(1000*result['grab']), float(COM_X),float(COM_Y),float(percentile),result['percentile']))
+
 ## Disables the 3.3V, 120mA output on GPIO pin 3 (red jacketed lead)
 #voltage_mode = 0x0000000
 #c.writeRegister(output_voltage, voltage_mode)
@@ -234,7 +241,11 @@ def updateData():
 #c.disconnect()
 
 #print "Done!"
-updateData()
+acquisition.start()
+timer=QtCore.QTimer()
+timer.timeout.connect(updateDisplay)
+timer.start(interval)
+app.aboutToQuit.connect(acquisition.stop)
 ## Start Qt event loop unless running in interactive mode.
 if __name__ == '__main__':
     import sys
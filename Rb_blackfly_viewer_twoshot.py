@@ -22,6 +22,8 @@
 #=============================================================================
 # For fitting
 import Rb_blackfly_image_gauss as fits
+from BlackflyCamera import DefectMap, SiteClassifier, opening_in_roi
+from Rb_blackfly_acquisition import AcquisitionThread, FrameRateMeter
 
 # For plotting
 from pyqtgraph.Qt import QtCore, QtGui
@@ -53,8 +55,10 @@ win.show()  ## show widget alone in its own window
 win.setWindowTitle('Pointgrey Monitor by Minho')
 view = win.addViewBox()
 view.setAspectLocked(True) # lock the aspect ratio so pixels are always square
+view.invertY(True) # camera rows run top to bottom
 ## Create image item and textitem
-img = pg.ImageItem()
+# row-major lets us draw camera frames as they come, without transposing
+img = pg.ImageItem(axisOrder='row-major')
 scatter=pg.ScatterPlotItem()
 scatter2=pg.ScatterPlotItem()
 #scatter.setData(size=10,symbol='o',brush=(255,0,0))
@@ -172,6 +176,8 @@ c.writeRegister(shutter_address, shutter)
 
 settings= {"offsetX": 0, "offsetY": 0, "width": 960, "height":600, "pixelFormat": PyCapture2.PIXEL_FORMAT.MONO8}
 c.setGigEImageSettings(**settings)
+# Hot pixel map cached by a previous CALIBRATE_DEFECTS run, None if there is none
+defects=DefectMap.load('defect_maps',cameraSerial,(settings['offsetX'],settings['offsetY'],settings['width'],settings['height']))
 # Instructs the camera to retrieve only the newest image from the buffer each time the RetrieveBuffer() function is called.
 # Older images will be dropped.
 PyCapture2.GRAB_MODE = 0
@@ -183,8 +189,10 @@ c.setConfiguration(grabTimeout = timeToWait)
 c.startCapture()
 
 imageNum = 0
-interval=5 # ms
+max_fps=30 # cap on redraws per second
+interval=int(1000/max_fps) # ms
 percentile=99.5
+use_opening=True # remove isolated bright pixels left over after the defect map
 
 def calculate_statistics(data):
     percentile = 99.5
@@ -192,7 +200,10 @@ def calculate_statistics(data):
     threshold = np.percentile(data, percentile)  # Set threshold
     thresholdmask = data > threshold
     # Apply dilation-erosion to exclude isolated bright pixels
-    openingmask = binary_opening(thresholdmask)
+    if use_opening:
+        openingmask = opening_in_roi(thresholdmask)
+    else:
+        openingmask = thresholdmask
     temp=np.ma.array(data, mask=np.invert(openingmask))
     # Fill 0 to masked pixels so they do not contribute to the following center of mass calculation
     temp2=temp.filled(0)
@@ -202,29 +213,17 @@ def calculate_statistics(data):
     which_laser(temp2,COM_X,COM_Y,threshold)
     return COM_X, COM_Y,temp2
 
+classifier=SiteClassifier(spacing=42,half_width=15,half_height=15)
+
 def which_laser(preprocessed_data,COM_X,COM_Y,threshold):
     # Subimage analysis : Use the center of mass obtained from full analysis to distinguish red and FORT sites.
-    [fullwidth, fullheight]=np.shape(preprocessed_data)
-    [fort_spacer,subimage_halfheight,subimage_halfwidth]=[42,15,15]
-    verts=[[0,1],[0,-1]]
-    horiz=[[-2,0],[-1,0],[1,0],[2,0]]
-    temp_ones=np.ones((fullwidth,fullheight))
-    vert_detect=0
-    for i in verts:
-        X1=i[0]*fort_spacer+np.int(COM_X)-subimage_halfheight
-        X2=i[0]*fort_spacer+np.int(COM_X)+subimage_halfheight
-        Y1=i[1]*fort_spacer+np.int(COM_Y)-subimage_halfwidth
-        Y2=i[1]*fort_spacer+np.int(COM_Y)+subimage_halfwidth
-        temp_ones[X1:X2,Y1:Y2]=0
-        temp3=np.ma.array(preprocessed_data,mask=temp_ones)
-        temp4=temp3.filled(0)
-        [sub_X,sub_Y,sub_error]=locator(temp4,threshold)
-        if sub_error==0: # If vertical component exists,
-            vert_detect=1 # raise vert flag, claim this to be ground laser
-    if vert_detect==1:
+    # preprocessed_data is zero below threshold, so a bright neighbor site is simply a nonzero window sum
+    sites=classifier.classify(preprocessed_data,COM_X,COM_Y)
+    if sites['ground']: # If vertical component exists, claim this to be ground laser
         print "this is ground!"
-    elif vert_detect==0:
+    else:
         print "this is likely FORT"
+    return sites
 
 def locator(data,threshold):
     error=1
@@ -237,42 +236,75 @@ def locator(data,threshold):
 
     return [COM_X, COM_Y, error]
 
-def updateData():
-    try:
-        starttime=time.time()
-        image = c.retrieveBuffer()# Capture first image
-        data=np.array(image.getData())
-        latency=int(1000 * (time.time() - starttime))
-        image2 = c.retrieveBuffer() # Capture second image
-        data2=np.array(image2.getData())
-        nrows = PyCapture2.Image.getRows(image)   #finds the number of rows in the image data
-        ncols = PyCapture2.Image.getDataSize(image)/nrows   #finds the number of columns in the image data
-        reshapeddata1=np.reshape(data,(nrows,ncols))
-        reshapeddata2=np.reshape(data2,(nrows,ncols))
-        orienteddata1=np.flip(reshapeddata1.transpose(1,0),1)
-        orienteddata2=np.flip(reshapeddata2.transpose(1,0),1)
-        orienteddata=orienteddata1-orienteddata2
-        [FORT_COM_X,FORT_COM_Y,temp1]=calculate_statistics(orienteddata1)#np.unravel_index(np.argmax(orienteddata),orienteddata.shape) # locate maximum arg
-        [Ground_COM_X,Ground_COM_Y,temp2]=calculate_statistics(orienteddata2)#np.unravel_index(np.argmin(orienteddata),orienteddata.shape) # locate maximum arg
-        #displayeddata=np.absolute(orienteddata)
-        displayeddata=np.zeros((ncols,nrows,3))
-        displayeddata[:,:,0]=temp1#orienteddata1
-        displayeddata[:,:,1]=temp2#orienteddata2
-        displayeddata[:,:,2]=0#np.absolute(orienteddata1-orienteddata2)
-        img.setImage(displayeddata)
-        #img.setLevels([0,np.max(displayeddata)])
-        scatter.setData(pos=[[FORT_COM_X,FORT_COM_Y]],size=8,symbol='o',brush=(255,0,120))
-        scatter2.setData(pos=[[Ground_COM_X,Ground_COM_Y]],size=8,symbol='o',brush=(0,255,120))
-        text.setHtml("<font size=4>From {} <br /> "
-                         "Latency: {} ms, refresh time : {} ms <br/>"
-                         "Delta X:{:.2f}, Delta Y:{:.2f} <br/>".format(str(cameraSerial), int(latency), int(interval), float(FORT_COM_X-Ground_COM_X),float(FORT_COM_Y-Ground_COM_Y)))
-        QtCore.QTimer.singleShot(interval, updateData)
-    except PyCapture2.Fc2error as fc2Err:
-        #print "Error retrieving buffer : ", fc2Err
+def analyseFrames(frames):
+    # Runs on the acquisition thread, keep Qt calls out of here
+    [reshapeddata1,reshapeddata2]=frames # first and second image
+    if defects is not None:
+        defects.apply(reshapeddata1)
+        defects.apply(reshapeddata2)
+    # transposed views index as [x,y], so the analysis sees the same axes as before without a copy
+    orienteddata1=reshapeddata1.T
+    orienteddata2=reshapeddata2.T
+    [FORT_COM_X,FORT_COM_Y,temp1]=calculate_statistics(orienteddata1)#np.unravel_index(np.argmax(orienteddata),orienteddata.shape) # locate maximum arg
+    [Ground_COM_X,Ground_COM_Y,temp2]=calculate_statistics(orienteddata2)#np.unravel_index(np.argmin(orienteddata),orienteddata.shape) # locate maximum arg
+    return {
+        'FORT_image': temp1.T, # back to row-major views for display
+        'Ground_image': temp2.T,
+        'FORT': [FORT_COM_X,FORT_COM_Y],
+        'Ground': [Ground_COM_X,Ground_COM_Y]
+    }
+
+decimation=1 # draw every n-th pixel, raise for large ROIs
+levels_refresh=100 # frames between display level updates
+composite=None # uint8 RGB buffer reused between frames
+display_levels=None
+frames_since_levels=0
+
+def renderComposite(FORT_image,Ground_image):
+    # Fill the preallocated RGB buffer: red is the first shot, green the second
+    global composite, display_levels, frames_since_levels
+    red=FORT_image[::decimation,::decimation]
+    green=Ground_image[::decimation,::decimation]
+    if composite is None or composite.shape[:2]!=red.shape:
+        composite=np.zeros(red.shape+(3,),dtype=np.uint8) # blue stays 0
+        img.setTransform(QtGui.QTransform.fromScale(decimation,decimation))
+        display_levels=None
+    composite[:,:,0]=red
+    composite[:,:,1]=green
+    if display_levels is None or frames_since_levels>=levels_refresh:
+        display_levels=[0,max(int(composite.max()),1)]
+        frames_since_levels=0
+    frames_since_levels+=1
+    img.setImage(composite,levels=display_levels,autoLevels=False)
+
+acquisition=AcquisitionThread(c, analyseFrames, shots=2)
+framerate=FrameRateMeter()
+
+def updateDisplay():
+    # Draws only the newest result, anything older was dropped by the producer
+    result=acquisition.take()
+    if result is None:
+        return
+    if result['error'] is not None:
+        #print "Error retrieving buffer : ", result['error']
         text.setHtml("<font size=4> No image to draw or could not retrive image from the camera")
-        QtCore.QTimer.singleShot(interval, updateData)
+        return
+    renderComposite(result['FORT_image'],result['Ground_image'])
+    [FORT_COM_X,FORT_COM_Y]=result['FORT']
+    [Ground_COM_X,Ground_COM_Y]=result['Ground']
+    scatter.setData(pos=[[FORT_COM_X,FORT_COM_Y]],size=8,symbol='o',brush=(255,0,120))
+    scatter2.setData(pos=[[Ground_COM_X,Ground_COM_Y]],size=8,symbol='o',brush=(0,255,120))
+    framerate.tick()
+    latency=1000*(time.time()-result['acquired']) # frame readout to screen
+    text.setHtml("<font size=4>From {} <br /> "
+                     "FPS: {:.1f}, dropped: {}, latency: {} ms, grab wait: {} ms <br/>"
+                     "Delta X:{:.2f}, Delta Y:{:.2f} <br/>".format(str(cameraSerial), framerate.fps(), acquisition.dropped, int(latency), int(1000*result['grab']), float(FORT_COM_X-Ground_COM_X),float(Ground_COM_Y-FORT_COM_Y))) # rows grow downwards
 
-updateData()
+acquisition.start()
+timer=QtCore.QTimer()
+timer.timeout.connect(updateDisplay)
+timer.start(interval)
+app.aboutToQuit.connect(acquisition.stop)
 ## Start Qt event loop unless running in interactive mode.
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,480 @@
+"""blackfly_broker.py
+   Part of the future AQuA Cesium Controller software package
+
+   Sharded variant of blackfly_server.py. The broker answers clients with the
+   usual request/reply protocol and hands every request to one worker process
+   per camera serial. Each worker is a BlackflyServer owning a single camera,
+   so one camera's slow fit or driver stall never holds up another, and the
+   analysis of several cameras runs on several cores.
+
+   The client socket is a ROUTER, so the broker never waits for a worker:
+   it keeps taking client requests while earlier ones are still with the
+   workers, and answers each as soon as its workers replied. A request for
+   one camera therefore never waits for another camera.
+
+   Requests for one camera (those with a `serial`) go to its worker and the
+   reply is relayed as is. START, UPDATE, GET_RESULTS and GET_RESULTS_SINCE
+   go to every worker and the replies are merged. A worker that does not
+   answer within `worker_timeout` ms (`long_timeout` for CALIBRATE_DEFECTS
+   and TUNE_STREAM, which read many triggered frames) is reported with an
+   error and receives no new request until its late replies came in.
+
+   Each worker only sees its own camera, so whatever needs several cameras
+   at once is not available here: GET_JOINED_RESULTS is not routed, and
+   the `schedule_bandwidth` plan cannot space cameras that share a NIC.
+   Use the single-process server for those.
+   """
+
+import json
+import time
+import logging
+import collections
+import multiprocessing
+import zmq
+import PyCapture2
+from blackfly_server import BlackflyServer
+
+__author__ = 'Matthew Ebert'
+
+# actions that are meant for the worker of msg['serial']
+CAMERA_ACTIONS = (
+    'ADD_CAMERA', 'REMOVE_CAMERA', 'UPDATE_CAMERA', 'GET_IMAGE',
+    'CALIBRATE_DEFECTS', 'TUNE_STREAM'
+)
+# actions that every worker answers, the broker merges the replies
+RESULT_ACTIONS = ('GET_RESULTS', 'GET_RESULTS_SINCE')
+# actions that take their worker many triggers, timed with long_timeout
+LONG_ACTIONS = ('CALIBRATE_DEFECTS', 'TUNE_STREAM')
+
+
+def run_worker(settings):
+    """Entry point of a worker process."""
+    BlackflyServer(settings)
+
+
+def discover_cameras(num_cams, queue):
+    """Entry point of the discovery process, puts the camera info dicts."""
+    bus = PyCapture2.BusManager()
+    cameras = bus.discoverGigECameras(numCams=num_cams)
+    queue.put([c.__dict__ for c in cameras])
+
+
+class WorkerLink(object):
+    """Broker side of the connection to one worker process.
+
+    Requests go out on a DEALER socket with a request id in front of the
+    empty delimiter, which the worker's REP socket sends back with the reply.
+    Several requests can be in flight. The worker answers them in order, so
+    only the oldest is timed, counted from the reply before it. Once it
+    times out every pending request is given up and counts as late: late
+    replies are dropped when they arrive, and until then the worker is busy.
+    """
+
+    def __init__(self, context, serial, address):
+        self.serial = serial
+        self.address = address
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(address)
+        self.requests = 0
+        # id: (job, timeout in s) of the requests in flight, oldest first
+        self.pending = collections.OrderedDict()
+        # ids of requests that were given up but not answered yet
+        self.late = set()
+        # when the worker started on the oldest pending request
+        self.head_start = None
+
+    def busy(self):
+        """True while replies to given up requests are outstanding."""
+        return bool(self.late)
+
+    def send(self, msg, job, timeout):
+        if not self.pending:
+            self.head_start = time.time()
+        self.requests += 1
+        request_id = str(self.requests)
+        self.pending[request_id] = (job, timeout)
+        self.socket.send_multipart([request_id, '', json.dumps(msg)])
+
+    def deadline(self):
+        """Time the oldest pending request times out, None if there is none."""
+        if not self.pending:
+            return None
+        job, timeout = self.pending.itervalues().next()
+        return self.head_start + timeout
+
+    def receive(self):
+        """Read a reply, return (job, reply frames) or None if it was late."""
+        frames = self.socket.recv_multipart()
+        request_id = frames[0]
+        if request_id not in self.pending:
+            self.late.discard(request_id)
+            return None
+        job, timeout = self.pending.pop(request_id)
+        # the worker moves on to the next request now
+        self.head_start = time.time()
+        return job, frames[2:]
+
+    def expire(self):
+        """Give up on every pending request, return their jobs."""
+        jobs = [job for job, timeout in self.pending.values()]
+        self.late.update(self.pending)
+        self.pending.clear()
+        return jobs
+
+
+class Job(object):
+    """A client request waiting for the replies of its workers.
+
+    `finish` turns {serial: reply frames, None if the worker failed} into
+    the frames of the reply to the client.
+    """
+
+    def __init__(self, envelope, serials, finish):
+        self.envelope = envelope
+        self.finish = finish
+        self.replies = dict((serial, None) for serial in serials)
+        self.waiting = set(serials)
+
+    def deliver(self, serial, frames):
+        """Record a worker's reply; True once every worker answered."""
+        self.replies[serial] = frames
+        self.waiting.discard(serial)
+        return not self.waiting
+
+
+class BlackflyBroker(object):
+    """Front end routing client requests to one BlackflyServer per camera."""
+
+    settings = {
+        'protocol': "tcp",
+        'port': 55555,
+        'max_cameras': 2,
+        'worker_port': 55600,  # first of the localhost ports of the workers
+        'worker_timeout': 5000,  # ms to wait for worker replies
+        'long_timeout': 120000  # ms to wait for LONG_ACTIONS replies
+    }
+
+    def __init__(self, settings={}):
+        """Discover the cameras, start their workers and serve clients.
+
+        @param settings A dictionary containing the settings
+        """
+        for key in settings:
+            self.settings[key] = settings[key]
+        self.setup_logger()
+        # the driver and zmq are only touched after the workers are forked
+        self.get_cameras()
+        self.start_workers()
+        self.context = zmq.Context()
+        self.connect_workers()
+        self.setup_server()
+        self.loop()
+
+    def get_cameras(self):
+        """Discover the cameras, see BlackflyServer.get_cameras.
+
+        Discovery runs in a short-lived process, so the broker forks its
+        workers without a driver state of its own. available_cameras holds
+        the camera info as dicts.
+        """
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=discover_cameras,
+            args=(self.settings["max_cameras"], queue)
+        )
+        process.start()
+        self.available_cameras = queue.get()
+        process.join()
+
+    def start_workers(self):
+        """Start a worker process for every discovered camera."""
+        self.processes = {}
+        self.ports = {}
+        for i, camera_info in enumerate(self.available_cameras):
+            serial = camera_info['serialNumber']
+            port = self.settings['worker_port'] + i
+            worker_settings = {
+                'protocol': 'tcp',
+                'host': '127.0.0.1',
+                'port': port,
+                'max_cameras': self.settings['max_cameras']
+            }
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(worker_settings,)
+            )
+            process.daemon = True
+            process.start()
+            self.processes[serial] = process
+            self.ports[serial] = port
+
+    def connect_workers(self):
+        """Open the link to every worker."""
+        self.workers = {}
+        for serial, port in self.ports.items():
+            address = 'tcp://127.0.0.1:{}'.format(port)
+            self.workers[serial] = WorkerLink(self.context, serial, address)
+            self.logger.info('worker for `{}` at `{}`'.format(serial, address))
+
+    def setup_server(self):
+        """Bind the client socket."""
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        addr = "{}://*:{}".format(
+            self.settings["protocol"],
+            self.settings["port"]
+        )
+        self.logger.info("broker binding to: `{}`".format(addr))
+        self.socket.bind(addr)
+
+    def setup_logger(self):
+        """Initialize a logger for the broker."""
+        logger = logging.getLogger(__name__)
+        logger.setLevel(logging.INFO)
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        fmtstr = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        ch.setFormatter(logging.Formatter(fmtstr))
+        logger.addHandler(ch)
+        self.logger = logger
+
+    def loop(self):
+        """Serve clients until interrupted; the workers acquire on their own.
+
+        The poller wakes up for client requests, worker replies and the
+        next worker deadline.
+        """
+        err_msg = "Unexpected exception encountered closing broker."
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        links = {}
+        for link in self.workers.values():
+            poller.register(link.socket, zmq.POLLIN)
+            links[link.socket] = link
+        while True:
+            try:
+                for sock, event in poller.poll(self.poll_timeout()):
+                    if sock is self.socket:
+                        self.receive_request()
+                    else:
+                        self.receive_reply(links[sock])
+                self.expire_requests()
+            except KeyboardInterrupt:
+                self.logger.info('Shutting down broker nicely.')
+                break
+            except:
+                self.logger.exception(err_msg)
+                break
+        self.shutdown()
+
+    def poll_timeout(self):
+        """ms until the next worker deadline, None if nothing is pending."""
+        deadlines = [link.deadline() for link in self.workers.values()]
+        deadlines = [d for d in deadlines if d is not None]
+        if not deadlines:
+            return None
+        return max(int(1000 * (min(deadlines) - time.time())) + 1, 0)
+
+    def receive_request(self):
+        """Read a client request and route it."""
+        frames = self.socket.recv_multipart()
+        if '' not in frames:
+            self.logger.error('request without an envelope dropped')
+            return
+        # the routing frames up to the empty delimiter address the reply
+        split = frames.index('') + 1
+        envelope = frames[:split]
+        msg = json.loads(frames[split])
+        self.logger.info(msg)
+        self.parse_msg(envelope, msg)
+
+    def receive_reply(self, link):
+        """Read a worker reply and answer its client once the job is done."""
+        received = link.receive()
+        if received is None:
+            self.logger.warning('late reply from worker `{}`'.format(link.serial))
+            return
+        job, frames = received
+        if job.deliver(link.serial, frames):
+            self.complete(job)
+
+    def expire_requests(self):
+        """Fail the requests of workers that missed their deadline."""
+        now = time.time()
+        for link in self.workers.values():
+            deadline = link.deadline()
+            if deadline is None or deadline > now:
+                continue
+            self.logger.error('worker `{}` timed out'.format(link.serial))
+            for job in link.expire():
+                if job.deliver(link.serial, None):
+                    self.complete(job)
+
+    def send_json(self, envelope, obj):
+        """Answer a client right away."""
+        self.socket.send_multipart(envelope + [json.dumps(obj)])
+
+    def complete(self, job):
+        """Answer the client of a finished job."""
+        self.socket.send_multipart(job.envelope + job.finish(job.replies), copy=False)
+
+    def parse_msg(self, envelope, msg):
+        """Route a client request to the workers, or answer it directly."""
+        action = msg.get('action')
+        if action == 'ECHO':
+            msg['status'] = 0
+            self.send_json(envelope, msg)
+        elif action == 'GET_CAMERAS':
+            self.send_json(envelope, {
+                'cameras': self.available_cameras,
+                'status': 0,
+                'message': 'success'
+            })
+        elif action in CAMERA_ACTIONS:
+            self.forward(envelope, msg)
+        elif action == 'START':
+            self.dispatch(
+                envelope,
+                dict((serial, msg) for serial in self.workers),
+                self.reply_status
+            )
+        elif action == 'UPDATE':
+            self.update(envelope, msg)
+        elif action in RESULT_ACTIONS:
+            self.dispatch(
+                envelope,
+                dict((serial, msg) for serial in self.workers),
+                self.merge_results
+            )
+        else:
+            error_msg = 'Unrecognized action requested: `{}`'
+            msg['status'] = 1
+            msg['message'] = error_msg.format(action)
+            self.send_json(envelope, msg)
+
+    def dispatch(self, envelope, requests, finish, failed=()):
+        """Send {serial: msg} to the workers without waiting for them.
+
+        The client is answered with finish(replies) once every worker
+        replied or timed out. Busy workers and the serials in `failed` are
+        counted as failed right away.
+        """
+        job = Job(envelope, list(requests) + list(failed), finish)
+        for serial in failed:
+            job.deliver(serial, None)
+        for serial, msg in requests.items():
+            link = self.workers[serial]
+            if link.busy():
+                self.logger.warning('worker `{}` is still busy'.format(serial))
+                job.deliver(serial, None)
+                continue
+            if msg.get('action') in LONG_ACTIONS:
+                timeout = self.settings['long_timeout']
+            else:
+                timeout = self.settings['worker_timeout']
+            link.send(msg, job, timeout / 1000.0)
+        if not job.waiting:
+            self.complete(job)
+
+    def forward(self, envelope, msg):
+        """Relay a request for one camera to its worker and the reply back."""
+        serial = msg.get('serial')
+        if serial not in self.workers:
+            self.send_json(envelope, {
+                'status': 1,
+                'message': 'Camera: `{}` has no worker.'.format(serial)
+            })
+            return
+
+        def relay(replies):
+            frames = replies[serial]
+            if frames is None:
+                return [json.dumps({
+                    'status': 1,
+                    'message': 'Camera: `{}` worker did not answer.'.format(serial)
+                })]
+            return frames
+
+        self.dispatch(envelope, {serial: msg}, relay)
+
+    def update(self, envelope, msg):
+        """Give every worker the part of the settings for its camera."""
+        requests = {}
+        unknown = []
+        client_cams = msg['settings']['cameras']
+        for c in client_cams:
+            serial = client_cams[c]['serial']
+            if serial not in self.workers:
+                unknown.append(serial)
+                continue
+            request = requests.setdefault(serial, {
+                'action': 'UPDATE',
+                'settings': {'cameras': {}}
+            })
+            request['settings']['cameras'][c] = client_cams[c]
+        if unknown:
+            self.logger.error('no worker for cameras: {}'.format(unknown))
+        self.dispatch(envelope, requests, self.reply_status, unknown)
+
+    def reply_status(self, replies):
+        """Reply with the worst status of the workers' replies."""
+        status = 0
+        failed = []
+        for serial, frames in replies.items():
+            if frames is None:
+                failed.append(serial)
+                continue
+            status = max(status, json.loads(frames[0])['status'])
+        if failed:
+            status = 1
+            resp = 'No reply from cameras: {}'.format(sorted(failed))
+        elif status:
+            resp = 'Error reported by a camera worker.'
+        else:
+            resp = 'success'
+        return [json.dumps({'status': status, 'message': resp})]
+
+    def merge_results(self, replies):
+        """Merge the camera_data of the workers' result replies.
+
+        Columnar replies carry one raw frame per camera; the frames are
+        collected and the `frame` indices renumbered.
+        """
+        header = {'camera_data': {}, 'status': 0, 'message': 'success'}
+        buffers = []
+        for serial, frames in replies.items():
+            if frames is None:
+                header['camera_data'][serial] = {
+                    'error': 1,
+                    'message': 'worker did not answer'
+                }
+                header['status'] = 1
+                header['message'] = 'Error retrieving results.'
+                continue
+            reply = json.loads(frames[0])
+            if reply.get('status'):
+                header['status'] = reply['status']
+                header['message'] = reply['message']
+            if 'encoding' in reply:
+                header['encoding'] = reply['encoding']
+            for camera, data in reply['camera_data'].items():
+                if 'frame' in data:
+                    buffers.append(frames[data['frame']])
+                    data['frame'] = len(buffers)
+                header['camera_data'][camera] = data
+        return [json.dumps(header)] + buffers
+
+    def shutdown(self):
+        """Stop the workers and close the sockets."""
+        for serial, process in self.processes.items():
+            process.terminate()
+            process.join()
+        for link in self.workers.values():
+            link.socket.close()
+        self.socket.close()
+        self.context.term()
+
+
+if __name__ == "__main__":
+    bfb = BlackflyBroker()
@@ -1,46 +1,385 @@
-import zmq
+"""blackfly_client.py
+   Part of the future AQuA Cesium Controller software package
+
+   Client library for blackfly_server.py and blackfly_broker.py.
+
+   BlackflyClient talks to one server. Requests go out on a DEALER socket
+   tagged with a request id, so several requests can be in flight at once
+   (pipelined or asynchronous) and a reply that arrives after its request
+   timed out is recognized and dropped. Once nothing else is in flight a
+   timed out socket is closed and reconnected, and read-only requests are
+   retried.
+   Binary replies (GET_IMAGE with compression, columnar results) are decoded
+   straight from the received zmq frames without copying.
+
+   BlackflyClientPool spreads the cameras of several servers behind the
+   same interface.
+
+   Run as a script to list the cameras of a server and fetch one image:
+       python blackfly_client.py [serial] [address]
+   """
+
+import sys
+import time
 import json
-import pprint
-
-context = zmq.Context()
-socket = context.socket(zmq.REQ)
-socket.setsockopt(zmq.RCVTIMEO, 5000)
-addr = "{}://{}:{}".format("tcp", "127.0.0.1", 55555)
-print addr
-socket.connect(addr)
-cmd = {
-    'action': 'GET_CAMERAS'
-}
-print cmd
-socket.send(json.dumps(cmd))
-resp = json.loads(socket.recv())
-print "status: " + str(resp["status"])
-print "server message: " + resp["message"]
-print "cameras:"
-for c in resp["cameras"]:
-    print "\tserNo: {}".format(c["serialNumber"])
-    print "\tIP: {}".format(c["ipAddress"])
-    print
-
-for c in resp["cameras"]:
-    if c['serialNumber'] == 16483677:
-        camera = c
-
-cmd = {
-    'action': 'ADD_CAMERA',
-    'serial': camera['serialNumber']
-}
-socket.send(json.dumps(cmd))
-resp = json.loads(socket.recv())
-print "status: " + str(resp["status"])
-print "server message: " + resp["message"]
-
-cmd = {
-    'action': 'GET_IMAGE',
-    'serial': camera['serialNumber']
-}
-socket.send(json.dumps(cmd))
-resp = json.loads(socket.recv())
-print "status: " + str(resp["status"])
-print "server message: " + resp["message"]
-print "image: {}".format(resp["image"])
+import uuid
+import zmq
+from blackfly_encoding import decode_frame, unpack_columnar
+
+__author__ = 'Matthew Ebert'
+
+# requests that can be repeated safely after a timeout
+IDEMPOTENT_ACTIONS = (
+    'ECHO', 'GET_CAMERAS', 'GET_RESULTS_SINCE', 'GET_JOINED_RESULTS'
+)
+# ms to wait for actions that need many hardware triggers
+CALIBRATION_TIMEOUT = 120000
+
+
+class BlackflyError(Exception):
+    """The server answered with a non-zero status."""
+
+
+class BlackflyTimeout(BlackflyError):
+    """No reply within the timeout, after all retries."""
+
+
+class PendingReply(object):
+    """Handle for a request sent with BlackflyClient.send."""
+
+    def __init__(self, client, request_id):
+        self.client = client
+        self.request_id = request_id
+
+    def ready(self):
+        """True once the reply has arrived; does not block."""
+        self.client.collect(0)
+        return self.request_id in self.client.replies
+
+    def result(self, timeout=None):
+        """Wait for the reply and return (header, frames)."""
+        return self.client.receive(self.request_id, timeout)
+
+
+class BlackflyClient(object):
+    """Connection to one Blackfly server."""
+
+    def __init__(self, address="tcp://127.0.0.1:55555", timeout=5000,
+                 retries=2, context=None):
+        """
+        @param address zmq address of the server or broker
+        @param timeout ms to wait for a reply
+        @param retries extra attempts for read-only requests that time out
+        """
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+        self.context = context or zmq.Context.instance()
+        # identifies this client for delta compressed GET_IMAGE replies
+        self.client_id = uuid.uuid4().hex
+        self.requests = 0
+        # replies received for requests nobody has asked for yet
+        self.replies = {}
+        self.outstanding = set()
+        # per serial: (seq, frames) of the last image, reference for 'delta'
+        self.images = {}
+        self.socket = None
+        self.connect()
+
+    def connect(self):
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.address)
+
+    def reset(self):
+        """Throw the socket away, e.g. after a timeout, and reconnect."""
+        self.socket.close()
+        self.replies = {}
+        self.outstanding = set()
+        self.connect()
+
+    def close(self):
+        self.socket.close()
+
+    # low level request handling
+
+    def send(self, msg):
+        """Send a request without waiting; returns a PendingReply.
+
+        Any number of requests may be in flight, the server answers them in
+        order.
+        """
+        self.requests += 1
+        request_id = str(self.requests)
+        self.socket.send_multipart([request_id, '', json.dumps(msg)])
+        self.outstanding.add(request_id)
+        return PendingReply(self, request_id)
+
+    def collect(self, timeout):
+        """Receive replies for up to timeout ms; True if any arrived."""
+        received = False
+        while self.socket.poll(timeout):
+            frames = self.socket.recv_multipart(copy=False)
+            request_id = frames[0].bytes
+            if request_id in self.outstanding:
+                self.outstanding.discard(request_id)
+                header = json.loads(frames[2].bytes)
+                self.replies[request_id] = (header, frames[3:])
+            received = True
+            timeout = 0
+        return received
+
+    def receive(self, request_id, timeout=None):
+        """Wait for the reply to request_id and return (header, frames).
+
+        Raises BlackflyTimeout if it does not come within timeout ms. A late
+        reply is dropped; other requests in flight keep waiting, and the
+        socket is reset once none is left.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout / 1000.0
+        while request_id not in self.replies:
+            remaining = int(1000 * (deadline - time.time()))
+            if remaining <= 0:
+                self.outstanding.discard(request_id)
+                if not self.outstanding:
+                    # drop requests still queued for a server that is gone
+                    self.reset()
+                raise BlackflyTimeout('No reply from `{}`.'.format(self.address))
+            self.collect(remaining)
+        return self.replies.pop(request_id)
+
+    def request(self, msg, retries=None, timeout=None):
+        """Send msg and wait for its reply, retrying read-only requests.
+
+        @param timeout ms per attempt, the client's timeout by default
+        @return (header dict, list of binary zmq frames)
+        """
+        if retries is None:
+            retries = self.retries if msg['action'] in IDEMPOTENT_ACTIONS else 0
+        for attempt in range(retries + 1):
+            pending = self.send(msg)
+            try:
+                return pending.result(timeout)
+            except BlackflyTimeout:
+                if attempt == retries:
+                    raise
+
+    def pipeline(self, msgs):
+        """Send all msgs at once, then return their replies in order."""
+        pending = [self.send(msg) for msg in msgs]
+        return [p.result() for p in pending]
+
+    def command(self, msg, timeout=None):
+        """request() that raises BlackflyError on a non-zero status."""
+        header, frames = self.request(msg, timeout=timeout)
+        if header.get('status'):
+            raise BlackflyError(header.get('message'))
+        return header
+
+    # server actions
+
+    def echo(self, **kwargs):
+        msg = dict(kwargs, action='ECHO')
+        return self.request(msg)[0]
+
+    def get_cameras(self):
+        """List of camera info dicts of the cameras the server discovered."""
+        return self.command({'action': 'GET_CAMERAS'})['cameras']
+
+    def add_camera(self, serial, **parameters):
+        msg = dict(parameters, action='ADD_CAMERA', serial=serial)
+        return self.command(msg)
+
+    def remove_camera(self, serial):
+        return self.command({'action': 'REMOVE_CAMERA', 'serial': serial})
+
+    def update(self, cameras):
+        """Send camera parameters, {name: parameters with a 'serial'}."""
+        return self.command({
+            'action': 'UPDATE',
+            'settings': {'cameras': cameras}
+        })
+
+    def update_camera(self, serial, trigger_delay=None, exposure_time=None):
+        msg = {'action': 'UPDATE_CAMERA', 'serial': serial}
+        if trigger_delay is not None:
+            msg['trigger_delay'] = trigger_delay
+        if exposure_time is not None:
+            msg['exposure_time'] = exposure_time
+        return self.command(msg)
+
+    def start(self):
+        """Arm all cameras for the next hardware trigger."""
+        return self.command({'action': 'START'})
+
+    def calibrate_defects(self, serial, num_frames=None,
+                          timeout=CALIBRATION_TIMEOUT):
+        """Number of hot pixels found in num_frames dark frames."""
+        msg = {'action': 'CALIBRATE_DEFECTS', 'serial': serial}
+        if num_frames is not None:
+            msg['numFrames'] = num_frames
+        return self.command(msg, timeout)['bad_pixels']
+
+    def tune_stream(self, serial, packet_sizes=None, inter_packet_delays=None,
+                    num_frames=None, timeout=CALIBRATION_TIMEOUT):
+        """Return (best stream setting, per-candidate results).
+
+        The sweep streams num_frames triggered frames per candidate, so
+        `timeout` (ms) must cover all of them.
+        """
+        msg = {'action': 'TUNE_STREAM', 'serial': serial}
+        if packet_sizes is not None:
+            msg['packetSizes'] = packet_sizes
+        if inter_packet_delays is not None:
+            msg['interPacketDelays'] = inter_packet_delays
+        if num_frames is not None:
+            msg['numFrames'] = num_frames
+        header = self.command(msg, timeout)
+        return header['best'], header['results']
+
+    def get_results(self):
+        """Latest stats per camera; clears them on the server."""
+        return self.request({'action': 'GET_RESULTS'})[0]['camera_data']
+
+    def get_results_since(self, since=None, columnar=False):
+        """History entries newer than `since` ({serial: seq}).
+
+        @return {serial: {'last': seq, 'results': entries}}; with columnar
+            the entries are a structured numpy array (see blackfly_encoding)
+        """
+        msg = {'action': 'GET_RESULTS_SINCE', 'since': since or {}}
+        if columnar:
+            msg['encoding'] = 'columnar'
+        header, frames = self.request(msg)
+        results = header['camera_data']
+        if columnar:
+            for data in results.values():
+                if 'frame' in data:
+                    buf = frames[data['frame'] - 1]
+                    data['results'] = unpack_columnar(data['dtype'], buf)
+        return results
+
+    def get_joined_results(self, since=0):
+        """Per-trigger joined records of a synchronized server."""
+        return self.request({'action': 'GET_JOINED_RESULTS', 'since': since})[0]
+
+    def get_image(self, serial, compression=None, level=None, roi=None,
+                  binning=None, stride=None):
+        """Frames of the last measurement of a camera as numpy arrays.
+
+        With compression ('none', 'zlib' or 'delta') the frames arrive as
+        binary zmq frames and are decoded without copying where possible;
+        'delta' keeps the previous frames of each camera as reference.
+        """
+        msg = {'action': 'GET_IMAGE', 'serial': serial}
+        for key, value in (('compression', compression), ('level', level),
+                           ('roi', roi), ('binning', binning),
+                           ('stride', stride)):
+            if value is not None:
+                msg[key] = value
+        if compression == 'delta':
+            msg['client'] = self.client_id
+            msg['have'] = self.images.get(serial, (None, []))[0]
+        header, frames = self.request(msg)
+        if compression is None:
+            import numpy
+            return [numpy.array(image) for image in header['image']]
+        if header.get('status') and not header.get('frames'):
+            raise BlackflyError(header.get('message'))
+        references = self.images.get(serial, (None, []))[1]
+        images = []
+        for i, meta in enumerate(header.get('frames', [])):
+            reference = references[i] if i < len(references) else None
+            images.append(decode_frame(frames[i], meta, reference))
+        if compression == 'delta':
+            self.images[serial] = (header['seq'], images)
+        return images
+
+
+class BlackflyClientPool(object):
+    """Several servers (or brokers) behind one client interface.
+
+    Cameras are routed to the server that reported them in GET_CAMERAS.
+    Requests for all cameras are pipelined to every server that answered
+    the last discover().
+    """
+
+    def __init__(self, addresses, **kwargs):
+        self.clients = [BlackflyClient(address, **kwargs) for address in addresses]
+        self.routes = {}
+        self.servers = []
+        self.discover()
+
+    def discover(self):
+        """Ask every server for its cameras and remember where they are."""
+        self.routes = {}
+        self.servers = []
+        pending = [(c, c.send({'action': 'GET_CAMERAS'})) for c in self.clients]
+        for client, reply in pending:
+            try:
+                header, frames = reply.result()
+            except BlackflyTimeout:
+                continue
+            self.servers.append(client)
+            for camera in header.get('cameras', []):
+                self.routes[camera['serialNumber']] = client
+        return self.routes
+
+    def client(self, serial):
+        """The client of the server that owns camera `serial`."""
+        try:
+            return self.routes[serial]
+        except KeyError:
+            raise BlackflyError('Camera: `{}` is on no known server.'.format(serial))
+
+    def broadcast(self, msg):
+        """Send msg to every server at once; returns {client: header}."""
+        pending = [(c, c.send(msg)) for c in self.servers]
+        replies = {}
+        for client, reply in pending:
+            try:
+                replies[client] = reply.result()[0]
+            except BlackflyTimeout:
+                replies[client] = None
+        return replies
+
+    def start(self):
+        """Arm the cameras of all servers; raises if any server failed."""
+        failed = [c.address for c, h in self.broadcast({'action': 'START'}).items()
+                  if h is None or h.get('status')]
+        if failed:
+            raise BlackflyError('START failed on: {}'.format(failed))
+
+    def get_results(self):
+        """Merged camera_data of every server's GET_RESULTS reply."""
+        results = {}
+        for header in self.broadcast({'action': 'GET_RESULTS'}).values():
+            if header is not None:
+                results.update(header['camera_data'])
+        return results
+
+    def get_image(self, serial, **kwargs):
+        return self.client(serial).get_image(serial, **kwargs)
+
+    def add_camera(self, serial, **parameters):
+        return self.client(serial).add_camera(serial, **parameters)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+
+if __name__ == "__main__":
+    serial = int(sys.argv[1]) if len(sys.argv) > 1 else 16483677
+    address = sys.argv[2] if len(sys.argv) > 2 else "tcp://127.0.0.1:55555"
+    client = BlackflyClient(address)
+    print "cameras:"
+    for c in client.get_cameras():
+        print "\tserNo: {}".format(c["serialNumber"])
+        print "\tIP: {}".format(c["ipAddress"])
+        print
+    print client.add_camera(serial)['message']
+    for image in client.get_image(serial, compression='zlib'):
+        print "image: {} {}".format(image.shape, image.dtype)
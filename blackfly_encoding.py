@@ -0,0 +1,156 @@
+"""blackfly_encoding.py
+   Part of the future AQuA Cesium Controller software package
+
+   Compact reply encodings shared by blackfly_server.py and its clients.
+
+   The default replies are JSON dictionaries with one key per statistic and
+   shot ('X0', 'Y1', 'EV0', ...). For history and batch queries the stats
+   can instead be packed column-wise into a structured numpy array, sent as
+   a raw buffer next to a small JSON header that describes its dtype.
+   Images requested with a `compression` option are likewise sent as raw
+   frames: uncompressed ('none'), zlib compressed ('zlib') or as the zlib
+   compressed difference to the previous frame sent to the same client
+   ('delta'). Mono8 frames are mostly dark, so both compress very well.
+   Before encoding, reduce_frame can cut a frame down to the sub-rectangle,
+   binning and stride a client asked for.
+   This module must not import PyCapture2 so that clients can use it.
+   """
+
+import zlib
+
+import numpy
+
+__author__ = 'Matthew Ebert'
+
+# columns present in every packed record, ahead of the stats columns
+RECORD_FIELDS = [
+    ('seq', '<i8'), ('time', '<f8'), ('stamp', '<f8'), ('received', '<f8'),
+    ('error', '<i4')
+]
+
+
+def stats_dtype(entries):
+    """Build a structured dtype with a float column per stats key.
+
+    List valued stats (e.g. per-site intensities) become sub-array columns.
+    """
+    shapes = {}
+    for entry in entries:
+        for key, value in entry['stats'].items():
+            if key not in shapes:
+                shapes[key] = numpy.shape(value)
+    descr = list(RECORD_FIELDS)
+    for key in sorted(shapes):
+        if shapes[key]:
+            descr.append((str(key), '<f8', shapes[key]))
+        else:
+            descr.append((str(key), '<f8'))
+    return numpy.dtype(descr)
+
+
+def pack_columnar(entries):
+    """Pack result history entries into a structured array, one row each.
+
+    Stats missing from an entry are NaN.
+    """
+    dtype = stats_dtype(entries)
+    records = numpy.empty(len(entries), dtype=dtype)
+    for name, _ in RECORD_FIELDS:
+        records[name] = [entry.get(name) for entry in entries]
+    for name in dtype.names[len(RECORD_FIELDS):]:
+        column = records[name]
+        column[...] = numpy.nan
+        for i, entry in enumerate(entries):
+            value = entry['stats'].get(name)
+            if value is not None and numpy.shape(value) == column.shape[1:]:
+                column[i] = value
+    return records
+
+
+def dtype_to_json(dtype):
+    """JSON friendly description of a structured dtype."""
+    return [list(field) for field in dtype.descr]
+
+
+def dtype_from_json(descr):
+    """Inverse of dtype_to_json."""
+    fields = []
+    for field in descr:
+        if len(field) > 2:
+            fields.append((str(field[0]), str(field[1]), tuple(field[2])))
+        else:
+            fields.append((str(field[0]), str(field[1])))
+    return numpy.dtype(fields)
+
+
+def unpack_columnar(descr, buf):
+    """Turn a received buffer back into a structured array (no copy)."""
+    return numpy.frombuffer(buf, dtype=dtype_from_json(descr))
+
+
+COMPRESSION_METHODS = ('none', 'zlib', 'delta')
+
+
+def encode_frame(frame, method='zlib', level=6, reference=None):
+    """Encode one frame for transfer, return (bytes or buffer, meta dict).
+
+    For 'delta' the frame minus `reference` is compressed; uint8 arithmetic
+    wraps around, which makes the difference exactly reversible. Without a
+    matching reference a delta falls back to a plain zlib key frame.
+    """
+    frame = numpy.ascontiguousarray(frame)
+    meta = {
+        'shape': list(frame.shape),
+        'dtype': frame.dtype.str,
+        'method': method
+    }
+    if method == 'none':
+        return frame, meta
+    if method == 'delta':
+        if reference is not None and reference.shape == frame.shape:
+            frame = frame - reference
+        else:
+            meta['method'] = 'zlib'
+    return zlib.compress(frame.tobytes(), level), meta
+
+
+def decode_frame(buf, meta, reference=None):
+    """Inverse of encode_frame. The result is read-only, for 'none' it is
+    a view of `buf`.
+    """
+    dtype = numpy.dtype(str(meta['dtype']))
+    shape = tuple(meta['shape'])
+    if meta['method'] == 'none':
+        return numpy.frombuffer(buf, dtype=dtype).reshape(shape)
+    frame = numpy.frombuffer(zlib.decompress(buf), dtype=dtype).reshape(shape)
+    if meta['method'] == 'delta':
+        frame = frame + reference
+    return frame
+
+
+def reduce_frame(frame, roi=None, binning=1, stride=1):
+    """Crop, bin and decimate a frame before it is serialized.
+
+    @param roi [x, y, width, height] in frame pixels, clipped to the frame
+    @param binning integer factor; each bin x bin block is averaged, so the
+        dtype (and with it the delta encoding) is preserved. Rows and
+        columns that do not fill a whole block are dropped.
+    @param stride keep every stride-th pixel of the (binned) frame
+
+    Cropping and striding are views; only binning makes a (smaller) copy.
+    """
+    if roi is not None:
+        x, y, width, height = [max(int(v), 0) for v in roi]
+        frame = frame[y:y + height, x:x + width]
+    binning = int(binning)
+    if binning > 1:
+        rows = frame.shape[0] // binning
+        cols = frame.shape[1] // binning
+        blocks = frame[:rows * binning, :cols * binning].reshape(
+            rows, binning, cols, binning)
+        summed = blocks.sum(axis=(1, 3), dtype=numpy.uint32)
+        frame = (summed // (binning * binning)).astype(frame.dtype)
+    stride = int(stride)
+    if stride > 1:
+        frame = frame[::stride, ::stride]
+    return frame
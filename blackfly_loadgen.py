@@ -0,0 +1,310 @@
+"""blackfly_loadgen.py
+   Part of the future AQuA Cesium Controller software package
+
+   Load generator for blackfly_server.py and blackfly_broker.py.
+
+   N client threads, each with its own BlackflyClient, send a weighted mix
+   of actions at a combined target rate. Latency is measured from the time
+   a request was scheduled, so the time it waited behind a slow server
+   counts (no coordinated omission); the service time from the actual send
+   is reported next to it. The report lists latency percentiles, throughput
+   and error rates per action; runs can be saved as JSON and compared. With
+   --compression delta it also reports the share of frames that came back
+   as deltas rather than key frames.
+
+   UPDATE sends real camera settings (only the serial, but the server
+   applies it as an update and activates the camera if needed), so it is
+   only accepted in the mix together with --allow-update.
+
+   Examples:
+       python blackfly_loadgen.py --clients 4 --rate 200 --duration 10 \
+           --mix ECHO=5,GET_RESULTS=3,GET_IMAGE=1 --serial 16483677 \
+           --save run_a.json
+       python blackfly_loadgen.py --compare run_a.json run_b.json
+   """
+
+import sys
+import time
+import json
+import random
+import argparse
+import threading
+import numpy
+from blackfly_client import BlackflyClient, BlackflyTimeout
+
+__author__ = 'Matthew Ebert'
+
+ACTIONS = ('ECHO', 'GET_CAMERAS', 'GET_RESULTS', 'GET_IMAGE', 'UPDATE', 'START')
+PERCENTILES = (50, 90, 99)
+
+
+def parse_mix(text, allow_update=False):
+    """'ECHO=5,GET_RESULTS=1' -> [('ECHO', 5.0), ('GET_RESULTS', 1.0)]
+
+    UPDATE changes the cameras' settings and is refused unless
+    `allow_update` is set.
+    """
+    mix = []
+    for item in text.split(','):
+        action, _, weight = item.partition('=')
+        action = action.strip().upper()
+        if action not in ACTIONS:
+            raise ValueError('Unknown action `{}`.'.format(action))
+        if action == 'UPDATE' and not allow_update:
+            raise ValueError('UPDATE changes camera settings, pass --allow-update.')
+        mix.append((action, float(weight or 1)))
+    return mix
+
+
+def build_request(action, args, client_id=None, have=None):
+    """Message for one action of the mix.
+
+    Delta compressed GET_IMAGE requests carry the load client's id and the
+    seq of the frames it holds, like BlackflyClient.get_image.
+    """
+    msg = {'action': action}
+    if action == 'GET_IMAGE':
+        msg['serial'] = args.serial
+        if args.compression:
+            msg['compression'] = args.compression
+        if args.compression == 'delta':
+            msg['client'] = client_id
+            msg['have'] = have
+    elif action == 'UPDATE':
+        msg['settings'] = {'cameras': {'loadgen': {'serial': args.serial}}}
+    return msg
+
+
+class LoadClient(threading.Thread):
+    """One simulated client sending requests at `rate` per second.
+
+    Requests are scheduled on a fixed timetable; a client that falls behind
+    sends immediately. Latency counts from the scheduled time, service time
+    from the send, and the missed schedule also shows up as throughput
+    below the target.
+    """
+
+    def __init__(self, address, mix, rate, duration, args, seed):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.address = address
+        self.mix = mix
+        self.rate = rate
+        self.duration = duration
+        self.args = args
+        self.random = random.Random(seed)
+        # action -> list of (latency s, service time s, outcome) with
+        # outcome 'ok', 'status' (non-zero status) or 'timeout'
+        self.samples = dict((action, []) for action, weight in mix)
+        # seq of the last GET_IMAGE frames, reference for 'delta'
+        self.have = None
+        # GET_IMAGE frames received and how many of them were deltas
+        self.frames_received = 0
+        self.delta_frames = 0
+
+    def choose(self):
+        total = sum(weight for action, weight in self.mix)
+        pick = self.random.uniform(0, total)
+        for action, weight in self.mix:
+            pick -= weight
+            if pick <= 0:
+                return action
+        return self.mix[-1][0]
+
+    def run(self):
+        client = BlackflyClient(self.address, timeout=self.args.timeout, retries=0)
+        start = time.time()
+        # spread the clients over the first period
+        due = start + self.random.uniform(0, 1.0 / self.rate)
+        try:
+            while due < start + self.duration:
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                action = self.choose()
+                msg = build_request(action, self.args, client.client_id, self.have)
+                sent = time.time()
+                try:
+                    header, frames = client.request(msg, retries=0)
+                    outcome = 'status' if header.get('status') else 'ok'
+                    if action == 'GET_IMAGE':
+                        self.have = header.get('seq')
+                        metas = header.get('frames', [])
+                        self.frames_received += len(metas)
+                        self.delta_frames += sum(
+                            1 for meta in metas if meta['method'] == 'delta')
+                except BlackflyTimeout:
+                    outcome = 'timeout'
+                done = time.time()
+                self.samples[action].append((done - due, done - sent, outcome))
+                due += 1.0 / self.rate
+        finally:
+            client.close()
+
+
+def summarize(samples, elapsed):
+    """Latency and service time percentiles (ms), throughput and error rates."""
+    latencies = numpy.array([s[0] for s in samples]) * 1000
+    service = numpy.array([s[1] for s in samples]) * 1000
+    outcomes = [s[2] for s in samples]
+    count = len(samples)
+    summary = {
+        'count': count,
+        'errors': outcomes.count('status') / float(count) if count else 0.0,
+        'timeouts': outcomes.count('timeout') / float(count) if count else 0.0
+    }
+    answered = [o != 'timeout' for o in outcomes]
+    ok = latencies[answered] if count else latencies
+    ok_service = service[answered] if count else service
+    # answered requests per second
+    summary['throughput'] = len(ok) / elapsed if elapsed > 0 else 0.0
+    for p in PERCENTILES:
+        summary['p{}'.format(p)] = float(numpy.percentile(ok, p)) if len(ok) else None
+        summary['service_p{}'.format(p)] = (
+            float(numpy.percentile(ok_service, p)) if len(ok) else None
+        )
+    summary['max'] = float(ok.max()) if len(ok) else None
+    return summary
+
+
+def run(args):
+    """Drive the servers and return the report dict."""
+    mix = parse_mix(args.mix, args.allow_update)
+    per_client = args.rate / float(args.clients)
+    clients = []
+    for i in range(args.clients):
+        address = args.address[i % len(args.address)]
+        clients.append(LoadClient(address, mix, per_client, args.duration, args, i))
+    start = time.time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - start
+    report = {
+        'config': {
+            'address': args.address,
+            'clients': args.clients,
+            'rate': args.rate,
+            'duration': args.duration,
+            'mix': args.mix,
+            'compression': args.compression,
+            'allow_update': args.allow_update,
+            'started': start
+        },
+        'elapsed': elapsed,
+        'actions': {}
+    }
+    everything = []
+    for action, weight in mix:
+        samples = []
+        for c in clients:
+            samples.extend(c.samples[action])
+        everything.extend(samples)
+        report['actions'][action] = summarize(samples, elapsed)
+    report['total'] = summarize(everything, elapsed)
+    if args.compression == 'delta':
+        received = sum(c.frames_received for c in clients)
+        deltas = sum(c.delta_frames for c in clients)
+        report['delta'] = {
+            'frames': received,
+            'hit_rate': deltas / float(received) if received else None
+        }
+    return report
+
+
+def fmt(value, spec='{:10.2f}'):
+    return '{:>10}'.format('-') if value is None else spec.format(value)
+
+
+def print_report(report):
+    config = report['config']
+    print "{} clients, target {} req/s for {} s, mix {}".format(
+        config['clients'], config['rate'], config['duration'], config['mix'])
+    columns = ['count', 'throughput'] + ['p{}'.format(p) for p in PERCENTILES]
+    columns += ['max', 'service_p50', 'service_p99', 'errors', 'timeouts']
+    print "latency (ms) from the scheduled send, svc (service time) from the send"
+    print '{:<12}'.format('action') + ''.join(
+        '{:>11}'.format(c.replace('service_', 'svc_')) for c in columns)
+    rows = sorted(report['actions'].items()) + [('TOTAL', report['total'])]
+    for action, summary in rows:
+        line = '{:<12}'.format(action) + '{:>11}'.format(summary['count'])
+        line += ' ' + fmt(summary['throughput'])
+        for c in columns[2:-2]:
+            line += ' ' + fmt(summary[c])
+        line += ' ' + fmt(100 * summary['errors'], '{:9.2f}%')
+        line += ' ' + fmt(100 * summary['timeouts'], '{:9.2f}%')
+        print line
+    if 'delta' in report:
+        delta = report['delta']
+        rate = delta['hit_rate']
+        print "delta frames: {} of {} GET_IMAGE frames".format(
+            '-' if rate is None else '{:.1f}%'.format(100 * rate), delta['frames'])
+
+
+def compare(a, b):
+    """Print the change of every metric from report a to report b."""
+    print "{} -> {}".format(a['config']['mix'], b['config']['mix'])
+    metrics = ['throughput'] + ['p{}'.format(p) for p in PERCENTILES]
+    metrics += ['max', 'service_p99']
+    print '{:<12}'.format('action') + ''.join('{:>20}'.format(m) for m in metrics)
+    actions = sorted(set(a['actions']) & set(b['actions']))
+    rows = [(x, a['actions'][x], b['actions'][x]) for x in actions]
+    rows.append(('TOTAL', a['total'], b['total']))
+    for action, before, after in rows:
+        line = '{:<12}'.format(action)
+        for m in metrics:
+            if before[m] is None or after[m] is None:
+                line += '{:>20}'.format('-')
+                continue
+            change = 100.0 * (after[m] - before[m]) / before[m] if before[m] else 0.0
+            line += '{:>20}'.format('{:.2f} ({:+.1f}%)'.format(after[m], change))
+        print line
+    rates = [r.get('delta', {}).get('hit_rate') for r in (a, b)]
+    if None not in rates:
+        print "delta frames: {:.1f}% -> {:.1f}%".format(100 * rates[0], 100 * rates[1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--address', action='append',
+                        help='server address, repeat for several servers '
+                             '(default tcp://127.0.0.1:55555)')
+    parser.add_argument('--clients', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help='combined target requests per second')
+    parser.add_argument('--duration', type=float, default=10.0, help='s')
+    parser.add_argument('--mix', default='ECHO=1',
+                        help='weighted actions, e.g. ECHO=5,GET_RESULTS=1')
+    parser.add_argument('--allow-update', action='store_true',
+                        help='accept UPDATE in the mix; it sends camera '
+                             'settings to the servers')
+    parser.add_argument('--serial', type=int, default=16483677,
+                        help='camera for GET_IMAGE and UPDATE')
+    parser.add_argument('--compression', choices=['none', 'zlib', 'delta'],
+                        help='GET_IMAGE compression')
+    parser.add_argument('--timeout', type=int, default=5000, help='ms')
+    parser.add_argument('--save', help='write the report to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two saved reports instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        compare(before, after)
+        return 0
+    if not args.address:
+        args.address = ['tcp://127.0.0.1:55555']
+    report = run(args)
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,21 +11,45 @@
    popular demand.
    """
 
+import time
+import threading
+import collections
+import numpy
 import zmq
 import logging
 import PyCapture2
-from BlackflyCamera import BlackflyCamera
+from BlackflyCamera import BlackflyCamera, is_timeout
+from blackfly_encoding import pack_columnar, dtype_to_json
+from blackfly_encoding import COMPRESSION_METHODS, encode_frame, reduce_frame
 
 __author__ = 'Matthew Ebert'
 
+# bytes each GVSP packet occupies on the wire beyond its packetSize:
+# preamble 8, ethernet header 14, FCS 4 and the inter-frame gap 12
+ETHERNET_OVERHEAD = 38
+# IP (20), UDP (8) and GVSP (8) headers counted in packetSize
+PACKET_HEADERS = 36
+
 
 class BlackflyServer(object):
     """A ZMQ server interface for multiple pointgrey (FLIR) blackfly cameras."""
 
     settings = {
         'protocol': "tcp",
+        'host': "*",  # interface to bind, blackfly_broker workers use localhost
         'port': 55555,
-        'max_cameras': 2
+        'max_cameras': 2,
+        # share each NIC between the cameras streaming to it, see
+        # schedule_bandwidth
+        'schedule_bandwidth': False,
+        'link_capacity': 125e6,  # bytes/s, 1 GbE
+        'link_headroom': 0.9,  # fraction of the link the plan may fill
+        'packet_delay_tick': 8e-9,  # s per inter-packet delay unit
+        # join the cameras' results per trigger, see ResultJoiner
+        'synchronize': False,
+        'sync_match': 'sequence',  # or 'timestamp'
+        'sync_max_wait': 1.0,  # s a trigger waits for missing cameras
+        'sync_tolerance': 0.005  # s between timestamps of one trigger
     }
 
     def __init__(self, settings={}):
@@ -39,6 +63,21 @@ class BlackflyServer(object):
         # a dictionary of instantiated camera objects with serial numbers as
         # the keys
         self.cameras = {}
+        # last frames sent to each (client, serial) for delta compression
+        self.sent_frames = {}
+        # inputs and result of the last bandwidth plan
+        self.bandwidth_inputs = None
+        self.bandwidth_plan = {}
+        # per-trigger joined results and the cameras armed for the trigger
+        self.joiner = ResultJoiner(
+            self.settings['sync_match'],
+            self.settings['sync_max_wait'],
+            self.settings['sync_tolerance']
+        )
+        self.trigger = 0
+        self.armed = set()
+        # threads waiting for the cameras' frames, see FrameWatcher
+        self.watchers = {}
         # set up console logging
         self.setup_logger()
         # get available camera serial numbers
@@ -82,6 +121,7 @@ class BlackflyServer(object):
                 try:
                     self.cameras[serial].initialize()
                     self.cameras[serial].update(msg)
+                    self.start_watcher(serial)
                 except:
                     resp = "Problem initializing camera: `{}`"
                     logger = self.logger.exception
@@ -95,10 +135,163 @@ class BlackflyServer(object):
 
         resp = resp.format(serial)
         logger(resp)
+        self.schedule_bandwidth()
         return (status, resp, camera_info)
 
-    def check_cameras(self):
-        for serial in self.cameras:
+    def calibrate_defects(self, msg):
+        """Build the hot pixel map for a camera from a run of dark frames."""
+        serial = msg['serial']
+        status = 1
+        num_bad = 0
+        if serial not in self.cameras:
+            resp = "Camera: `{}` is not in list of active cameras."
+            logger = self.logger.error
+        else:
+            rearm = self.pause_watcher(serial)
+            try:
+                defects = self.cameras[serial].calibrate_defects(
+                    msg.get('numFrames')
+                )
+            except:
+                resp = "Problem calibrating defect map for camera: `{}`"
+                logger = self.logger.exception
+            else:
+                num_bad = len(defects.bad_pixels)
+                resp = "Camera: `{}` defect map calibrated."
+                status = 0
+                logger = self.logger.info
+            self.resume_watcher(serial, rearm)
+        resp = resp.format(serial)
+        logger(resp)
+        self.socket.send_json({
+            'bad_pixels': num_bad,
+            'status': status,
+            'message': resp
+        })
+
+    def tune_stream(self, msg):
+        """Sweep a camera's packet size and inter-packet delay.
+
+        Optional `packetSizes`, `interPacketDelays` and `numFrames` override
+        the camera's streamTuning settings.
+        """
+        serial = msg['serial']
+        status = 1
+        best = None
+        results = []
+        scheduled = None
+        if serial not in self.cameras:
+            resp = "Camera: `{}` is not in list of active cameras."
+            logger = self.logger.error
+        else:
+            rearm = self.pause_watcher(serial)
+            try:
+                best, results = self.cameras[serial].tune_stream(
+                    msg.get('packetSizes'),
+                    msg.get('interPacketDelays'),
+                    msg.get('numFrames')
+                )
+            except:
+                resp = "Problem tuning stream settings for camera: `{}`"
+                logger = self.logger.exception
+            else:
+                if best is None:
+                    resp = "Camera: `{}` streamed no frames while tuning."
+                    logger = self.logger.error
+                else:
+                    resp = "Camera: `{}` stream settings tuned."
+                    status = 0
+                    logger = self.logger.info
+                    # the packet size changed, so the frames' wire time did
+                    self.schedule_bandwidth()
+                    scheduled = self.cameras[serial].scheduled_delay
+                    if scheduled is not None and scheduled != best['interPacketDelay']:
+                        resp += (" The bandwidth plan overrides the "
+                                 "interPacketDelay with {}.".format(scheduled))
+            self.resume_watcher(serial, rearm)
+        resp = resp.format(serial)
+        logger(resp)
+        self.socket.send_json({
+            'best': best,
+            'results': results,
+            'scheduled_delay': scheduled,
+            'status': status,
+            'message': resp
+        })
+
+    def schedule_bandwidth(self):
+        """Space the packets of cameras that share a NIC.
+
+        The cameras are triggered together, so without a plan their frames
+        collide on the link and packets are resent. Cameras are grouped by
+        their host network and each gets an inter-packet delay (see
+        bandwidth_plan). The plan is only recomputed and written when a
+        frame size, packet size or the set of cameras changed. A camera that
+        rejects its delay is logged and retried with the next plan.
+        """
+        if not self.settings['schedule_bandwidth']:
+            return
+        streams = {}
+        for serial, camera in self.cameras.items():
+            try:
+                nic = camera.nic_key()
+                streams[serial] = (nic, camera.frame_bytes(), camera.packet_size())
+            except (AttributeError, KeyError, PyCapture2.Fc2error):
+                self.logger.exception('No stream info for camera `{}`'.format(serial))
+        if streams == self.bandwidth_inputs:
+            return
+        self.bandwidth_inputs = streams
+        self.bandwidth_plan = {}
+        for nic in set(info[0] for info in streams.values()):
+            link = dict(
+                (serial, info[1:]) for serial, info in streams.items()
+                if info[0] == nic
+            )
+            self.bandwidth_plan.update(bandwidth_plan(
+                link,
+                self.settings['link_capacity'],
+                self.settings['link_headroom'],
+                self.settings['packet_delay_tick']
+            ))
+        for serial, plan in self.bandwidth_plan.items():
+            try:
+                self.cameras[serial].schedule_packet_delay(plan['interPacketDelay'])
+            except PyCapture2.Fc2error:
+                self.logger.exception('Camera `{}` rejected its packet delay'.format(serial))
+                self.bandwidth_inputs = None
+        self.logger.info('bandwidth plan: {}'.format(self.bandwidth_plan))
+
+    def start_watcher(self, serial):
+        """Start the thread that reports frames of a camera to the loop."""
+        watcher = FrameWatcher(
+            self.context,
+            self.notify_address,
+            serial,
+            self.cameras[serial]
+        )
+        watcher.start()
+        self.watchers[serial] = watcher
+
+    def pause_watcher(self, serial):
+        """Take the camera from its FrameWatcher before reading frames here.
+
+        @return whether the camera was armed, for resume_watcher
+        """
+        if serial not in self.watchers:
+            return False
+        return self.watchers[serial].pause()
+
+    def resume_watcher(self, serial, rearm):
+        if serial in self.watchers:
+            self.watchers[serial].resume(rearm)
+
+    def check_cameras(self, serials):
+        """Analyse the cameras whose frames arrived."""
+        for serial in serials:
+            watcher = self.watchers.get(serial)
+            if watcher is not None and watcher.waiting():
+                # sent before a pause, the camera was armed again since
+                continue
             if self.cameras[serial].status == 'ACQUIRING':
                 err, data, stats = self.cameras[serial].GetImage()
                 if err == 0:
@@ -107,6 +300,15 @@ class BlackflyServer(object):
                 else:
                     self.logger.error('An error occurred getting an image.')
                 self.cameras[serial].stop_capture()
+                if self.settings['synchronize']:
+                    self.joiner.add(
+                        serial,
+                        self.cameras[serial].history[-1],
+                        self.trigger,
+                        self.armed
+                    )
+        if self.settings['synchronize']:
+            self.joiner.expire()
 
     def get_cameras(self):
         """Get all attached blackfly cameras.
@@ -142,19 +344,21 @@ class BlackflyServer(object):
         for c in self.cameras:
             msg = 'Fetching information from Camera: `{}`'.format(c)
             self.logger.info(msg)
-            err, data, stats = self.cameras[c].get_data()
+            # frames are fetched with GET_IMAGE, they do not fit in JSON
+            err, data, stats = self.cameras[c].get_data(frames=False)
             try:
                 results[c] = {
                     'error': err,
                     'data': data,
-                    'stats': stats
+                    'stats': stats,
+                    'buffer': self.cameras[c].buffer_occupancy()
                 }
             except AttributeError:
                 results[c] = {'error': 1, 'data': {}}
                 resp = 'Error retrieving image data.'
 
         try:
-            print results
+            self.logger.debug(results)
             self.socket.send_json({
             'camera_data': results,
             'status': status,
@@ -165,30 +369,171 @@ class BlackflyServer(object):
 
 
 
+    def get_results_since(self, msg):
+        """Return every result newer than the client's last sequence number.
+
+        `since` maps camera serial numbers to the last sequence number the
+        client has seen; cameras that are not listed return their whole
+        history. Nothing is cleared, so clients do not steal each other's
+        results.
+
+        With `encoding` set to 'columnar' the reply is multipart: a JSON
+        header followed by one raw structured-array buffer per camera (see
+        blackfly_encoding). The default 'json' encoding lists the entries.
+        """
+        since = msg.get('since', {})
+        columnar = msg.get('encoding', 'json') == 'columnar'
+        results = {}
+        buffers = []
+        for c in self.cameras:
+            # JSON turns the serial number keys into strings
+            last = since.get(str(c), since.get(c, 0))
+            entries = self.cameras[c].results_since(last)
+            results[c] = {'last': self.cameras[c].sequence}
+            if columnar:
+                records = pack_columnar(entries)
+                results[c]['dtype'] = dtype_to_json(records.dtype)
+                results[c]['frame'] = len(buffers) + 1
+                buffers.append(records)
+            else:
+                results[c]['results'] = entries
+        header = {
+            'camera_data': results,
+            'encoding': 'columnar' if columnar else 'json',
+            'status': 0,
+            'message': 'success'
+        }
+        if not buffers:
+            self.socket.send_json(header)
+            return
+        self.socket.send_json(header, zmq.SNDMORE)
+        for records in buffers[:-1]:
+            self.socket.send(records, zmq.SNDMORE, copy=False)
+        self.socket.send(buffers[-1], copy=False)
+
+    def get_joined_results(self, msg):
+        """Return the per-trigger joined records newer than `since`.
+
+        Only filled in synchronized mode. `unmatched` counts the camera
+        results that ended up in incomplete records, `pending` the triggers
+        still waiting for a camera.
+        """
+        self.joiner.expire()
+        self.socket.send_json({
+            'results': self.joiner.results_since(msg.get('since', 0)),
+            'last': self.joiner.sequence,
+            'unmatched': self.joiner.unmatched,
+            'pending': len(self.joiner.pending),
+            'status': 0,
+            'message': 'success'
+        })
+
     def get_image(self, msg):
-        """Retrieve a single image from a camera by serial number."""
+        """Retrieve a single image from a camera by serial number.
+
+        Without a `compression` key the frames are sent as JSON lists. With
+        `compression` set to 'none', 'zlib' (optionally with `level`) or
+        'delta' the reply is a JSON header followed by one raw frame each.
+        'delta' needs a `client` id; the client returns the `seq` of the
+        frames it holds as `have` and gets a key frame whenever that does
+        not match what the server last sent it.
+
+        Optional `roi` ([x, y, width, height]), `binning` and `stride` keys
+        shrink the frames on the server before they are serialized.
+
+        The frames of the last measurement are served without clearing them
+        or the camera's stats, so any number of viewers can fetch them.
+        """
         serial = msg['serial']
-        err, data, stats = self.cameras[serial].get_data()
+        camera = self.cameras[serial]
+        seq, err, data = camera.last_frames()
         resp = 'success'
         if err:
             resp = "An error was encountered acquiring image data."
             self.logger.error(resp)
-        self.socket.send_json({
-            'image': data.tolist(),
+        reduction = {
+            'roi': msg.get('roi'),
+            'binning': msg.get('binning', 1),
+            'stride': msg.get('stride', 1)
+        }
+        data = [reduce_frame(frame, **reduction) for frame in data]
+        method = msg.get('compression')
+        if method is None:
+            self.socket.send_json({
+                'image': [frame.tolist() for frame in data],
+                'status': err,
+                'message': resp
+            })
+            return
+        if method not in COMPRESSION_METHODS:
+            self.socket.send_json({
+                'status': 1,
+                'message': 'Unknown compression `{}`.'.format(method)
+            })
+            return
+        references = []
+        if method == 'delta':
+            key = (msg.get('client'), serial)
+            sent_seq, sent = self.sent_frames.get(key, (None, []))
+            if sent_seq is not None and sent_seq == msg.get('have'):
+                references = sent
+            # the frames live in camera buffers that the next shot reuses
+            self.sent_frames[key] = (seq, [f.copy() for f in data])
+        cpu_start = time.clock()
+        buffers = []
+        frames = []
+        raw_bytes = 0
+        sent_bytes = 0
+        for i, frame in enumerate(data):
+            reference = references[i] if i < len(references) else None
+            buf, meta = encode_frame(frame, method, msg.get('level', 6), reference)
+            raw_bytes += frame.nbytes
+            sent_bytes += frame.nbytes if method == 'none' else len(buf)
+            buffers.append(buf)
+            frames.append(meta)
+        header = {
+            'frames': frames,
+            'reduction': reduction,
+            'seq': seq,
+            'compression': method,
+            'ratio': float(raw_bytes) / sent_bytes if sent_bytes else 1.0,
+            'cpu_ms': 1000 * (time.clock() - cpu_start),
             'status': err,
             'message': resp
-        })
+        }
+        if not buffers:
+            self.socket.send_json(header)
+            return
+        self.socket.send_json(header, zmq.SNDMORE)
+        for buf in buffers[:-1]:
+            self.socket.send(buf, zmq.SNDMORE, copy=False)
+        self.socket.send(buffers[-1], copy=False)
 
     def loop(self):
-        """Run the server loop continuously."""
+        """Run the server loop continuously.
+
+        The loop sleeps in the poller until a client sends a request or a
+        FrameWatcher reports that all frames of a camera's measurement have
+        arrived, so they are analysed as soon as they are in and an idle
+        server uses no CPU.
+        """
         should_continue = True
         err_msg = "Unexpected exception encountered closing server."
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.notifications, zmq.POLLIN)
         while should_continue:
             try:
-                msg = self.socket.recv_json()
-                self.logger.info(msg)
-                self.parse_msg(msg)
-                self.check_cameras()
+                events = dict(poller.poll())
+                if self.notifications in events:
+                    arrived = set()
+                    while self.notifications.poll(0):
+                        arrived.add(int(self.notifications.recv()))
+                    self.check_cameras(arrived)
+                if self.socket in events:
+                    msg = self.socket.recv_json()
+                    self.logger.info(msg)
+                    self.parse_msg(msg)
             except zmq.ZMQError as e:
                 if e.errno != zmq.EAGAIN:
                     self.logger.exception(err_msg)
@@ -225,6 +570,13 @@ class BlackflyServer(object):
         if action == 'GET_RESULTS':
             valid = True
             self.get_results(msg)
+        # results newer than the client's last sequence numbers
+        if action == 'GET_RESULTS_SINCE':
+            valid = True
+            self.get_results_since(msg)
+        if action == 'GET_JOINED_RESULTS':
+            valid = True
+            self.get_joined_results(msg)
         # Initialize and update camera by serial number
         if action == 'ADD_CAMERA':
             valid = True
@@ -245,6 +597,14 @@ class BlackflyServer(object):
         if action == 'GET_IMAGE':
             valid = True
             self.get_image(msg)
+        # record dark frames and cache a hot pixel map by serial number
+        if action == 'CALIBRATE_DEFECTS':
+            valid = True
+            self.calibrate_defects(msg)
+        # sweep packet size and inter-packet delay of a camera by serial number
+        if action == 'TUNE_STREAM':
+            valid = True
+            self.tune_stream(msg)
         # software trigger to wait for next hardware trigger
         if action == 'START':
             valid = True
@@ -282,10 +642,13 @@ class BlackflyServer(object):
         """Initialize the server port and begin listening for instructions."""
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.REP)
-        # set polling to be short so that the cameras can be checked frequently
-        self.socket.setsockopt(zmq.RCVTIMEO, 50)
-        addr = "{}://*:{}".format(
+        # FrameWatcher threads push the serial of a camera with a new frame
+        self.notifications = self.context.socket(zmq.PULL)
+        self.notify_address = 'inproc://acquired-{}'.format(id(self))
+        self.notifications.bind(self.notify_address)
+        addr = "{}://{}:{}".format(
             self.settings["protocol"],
+            self.settings["host"],
             self.settings["port"]
         )
         self.logger.info("server binding to: `{}`".format(addr))
@@ -307,16 +670,31 @@ class BlackflyServer(object):
 
     def shutdown(self):
         """Close the server down."""
+        for watcher in self.watchers.values():
+            watcher.stop()
+        # stopping the capture also ends a retrieveBuffer call in progress
         for c in self.cameras:
             self.cameras[c].shutdown()
+        for watcher in self.watchers.values():
+            watcher.join(1.0)
+        self.notifications.close()
         self.socket.close()
         self.context.term()
 
     def start(self, msg):
         """Set all active cameras to wait for next hardware trigger."""
         try:
+            for c in self.cameras:
+                self.cameras[c].prepare_capture()
+            # a new auto ROI changes the frame size; plan while nothing streams
+            self.schedule_bandwidth()
             for c in self.cameras:
                 self.cameras[c].start_capture()
+                if c in self.watchers:
+                    self.watchers[c].arm()
+            # every armed camera sees the next hardware trigger
+            self.trigger += 1
+            self.armed = set(self.cameras)
             status = 0
             resp = "Acquisition successfully started."
             self.logger.info("Acquisition successfully started.")
@@ -388,6 +766,9 @@ class BlackflyServer(object):
                     # list add it now
                     self.logger.info('Activating camera: `{}`'.format(serial))
                     self.add_camera_task(client_cams[c])
+            # update() rewrote the stream settings from the parameters
+            self.bandwidth_inputs = None
+            self.schedule_bandwidth()
             status = 0
             resp = 'Update successful'
         except KeyError:
@@ -400,5 +781,256 @@ class BlackflyServer(object):
         })
 
 
+class FrameWatcher(threading.Thread):
+    """Wait for the frames of a measurement off the server loop.
+
+    Once armed by START the watcher blocks in retrieveBuffer until all
+    shotsPerMeasurement frames are in, puts them on the camera's frame_queue
+    and sends the camera serial over an inproc PUSH socket. The loop then
+    runs GetImage, which finds every shot queued, so the analysis and all
+    camera state stay on the loop thread and the loop never waits for a
+    frame.
+
+    `lock` is held while the watcher reads from the camera. Loop-thread
+    code that reads frames itself (defect calibration, stream tuning) calls
+    pause() first and resume() when done.
+    """
+
+    # s to wait after a failed retrieveBuffer before trying again
+    backoff = 0.05
+
+    def __init__(self, context, address, serial, camera):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.context = context
+        self.address = address
+        self.serial = serial
+        self.camera = camera
+        self.running = True
+        self.armed = threading.Event()
+        self.lock = threading.Lock()
+
+    def arm(self):
+        """Wait for the frames of the next trigger."""
+        self.armed.set()
+
+    def stop(self):
+        self.running = False
+        self.armed.set()
+
+    def pause(self):
+        """Stop waiting for frames; returns once the camera is free.
+
+        An armed camera stops capturing, which also ends a retrieveBuffer
+        call in progress, and its measurement is dropped.
+
+        @return True if the watcher was armed, pass it on to resume()
+        """
+        was_armed = self.armed.is_set()
+        self.armed.clear()
+        if was_armed:
+            self.camera.stop_capture()
+        self.lock.acquire()
+        return was_armed
+
+    def resume(self, rearm):
+        """Hand the camera back; with `rearm` capture restarts and waits."""
+        self.lock.release()
+        if rearm:
+            self.camera.start_capture()
+            self.arm()
+
+    def waiting(self):
+        """True while the watcher still waits for frames of this trigger."""
+        return self.armed.is_set()
+
+    def collect(self):
+        """Read the frames of one measurement; None if it was abandoned.
+
+        A grab timeout only means the trigger has not come yet, so the read
+        is retried. A frame that fails to read out for any other reason
+        while capture runs is kept as a None entry, so GetImage reports that
+        shot as failed. Each frame is copied into the camera's queued<shot>
+        workspace buffer.
+        """
+        shots = self.camera.parameters.get('shotsPerMeasurement', 1)
+        entries = []
+        with self.lock:
+            while len(entries) < shots:
+                if not (self.running and self.armed.is_set()):
+                    return None
+                try:
+                    image = self.camera.camera_instance.retrieveBuffer()
+                except PyCapture2.Fc2error as fc2Err:
+                    if not (self.running and self.armed.is_set()):
+                        return None
+                    if self.camera.status != 'ACQUIRING':
+                        self.armed.clear()
+                        return None
+                    if is_timeout(fc2Err):
+                        continue
+                    entries.append((None, None, time.time()))
+                    # do not spin if the camera keeps failing
+                    time.sleep(self.backoff)
+                    continue
+                entries.append(self.camera.frame_entry(image, len(entries)))
+        return entries
+
+    def run(self):
+        # zmq sockets belong to the thread that uses them
+        sock = self.context.socket(zmq.PUSH)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self.address)
+        try:
+            while True:
+                self.armed.wait()
+                if not self.running:
+                    break
+                entries = self.collect()
+                if entries is None:
+                    continue
+                self.camera.frame_queue.extend(entries)
+                self.armed.clear()
+                sock.send(str(self.serial))
+        finally:
+            sock.close()
+
+
+class ResultJoiner(object):
+    """Join per-camera results that belong to the same trigger.
+
+    In 'sequence' mode results carry the server's trigger number. In
+    'timestamp' mode the camera timestamps are moved onto the host clock
+    with a per-camera offset (the smallest difference seen so far between
+    the host time the frame left the driver and its camera time, i.e. the
+    offset with the least transfer delay) and results within `tolerance` of
+    each other are joined. The analysis time, which differs per camera,
+    does not enter the offset.
+
+    A record is complete once every camera armed for its trigger reported.
+    Records still open after `max_wait` seconds are closed incomplete, and
+    their results are counted as unmatched. Closed records go into a ring
+    with increasing sequence numbers, like BlackflyCamera.history.
+    """
+
+    def __init__(self, match='sequence', max_wait=1.0, tolerance=0.005, history=1000):
+        self.match = match
+        self.max_wait = max_wait
+        self.tolerance = tolerance
+        # open records, oldest first
+        self.pending = []
+        self.clock_offsets = {}
+        self.history = collections.deque(maxlen=history)
+        self.sequence = 0
+        self.unmatched = 0
+
+    def key(self, serial, entry, trigger):
+        """Trigger number or host-clock time of a camera result."""
+        if self.match == 'sequence' or entry.get('received') is None:
+            return trigger
+        offset = entry['received'] - entry['stamp']
+        offset = min(self.clock_offsets.get(serial, offset), offset)
+        self.clock_offsets[serial] = offset
+        return entry['stamp'] + offset
+
+    def find(self, key, serial):
+        for record in self.pending:
+            if serial in record['cameras']:
+                continue
+            if self.match == 'sequence' and record['key'] == key:
+                return record
+            if self.match != 'sequence' and abs(record['key'] - key) <= self.tolerance:
+                return record
+        return None
+
+    def add(self, serial, entry, trigger, expected):
+        """File a camera result; `expected` are the serials armed for it."""
+        key = self.key(serial, entry, trigger)
+        record = self.find(key, serial)
+        if record is None:
+            record = {
+                'key': key,
+                'opened': time.time(),
+                'expected': set(expected) | set([serial]),
+                'cameras': {}
+            }
+            self.pending.append(record)
+        record['cameras'][serial] = entry
+        if set(record['cameras']) >= record['expected']:
+            self.pending.remove(record)
+            self.close(record, True)
+
+    def expire(self, now=None):
+        """Close the records that waited longer than max_wait."""
+        if now is None:
+            now = time.time()
+        for record in list(self.pending):
+            if now - record['opened'] > self.max_wait:
+                self.pending.remove(record)
+                self.unmatched += len(record['cameras'])
+                self.close(record, False)
+
+    def close(self, record, complete):
+        self.sequence += 1
+        self.history.append({
+            'seq': self.sequence,
+            'time': time.time(),
+            'trigger': record['key'],
+            'complete': complete,
+            'missing': sorted(record['expected'] - set(record['cameras'])),
+            'cameras': record['cameras']
+        })
+
+    def results_since(self, seq):
+        """Closed records newer than sequence number `seq`."""
+        newer = []
+        for record in reversed(self.history):
+            if record['seq'] <= seq:
+                break
+            newer.append(record)
+        newer.reverse()
+        return newer
+
+
+def bandwidth_plan(streams, capacity, headroom, tick):
+    """Share one link between cameras that are triggered together.
+
+    Every camera gets a slice of the usable bandwidth proportional to the
+    bytes its frame puts on the wire, so all frames finish together after
+    total bytes / usable bandwidth: the earliest the last frame can arrive.
+    PyCapture2 offers no frame transmission delay, so rather than staggering
+    whole frames the packets are interleaved; every stream starts at the
+    trigger (transmit offset 0).
+
+    @param streams {serial: (frame bytes, packet size)} on this link
+    @param capacity link rate in bytes/s
+    @param headroom fraction of the link the cameras may use together
+    @param tick duration of one inter-packet delay unit in s
+    @return {serial: {'interPacketDelay', 'share', 'offset', 'done'}} with
+        share in bytes/s and the transmit offset and finish time in s
+    """
+    wire = {}
+    for serial, (frame_bytes, packet_size) in streams.items():
+        payload = packet_size - PACKET_HEADERS
+        packets = -(-frame_bytes // payload)
+        wire[serial] = packets * (packet_size + ETHERNET_OVERHEAD)
+    total = float(sum(wire.values()))
+    usable = capacity * headroom
+    plan = {}
+    for serial, wire_bytes in wire.items():
+        share = usable * wire_bytes / total
+        packet_wire = streams[serial][1] + ETHERNET_OVERHEAD
+        # a packet takes packet_wire / capacity on the link, the rest of
+        # its slot at `share` is left to the other cameras
+        gap = packet_wire / share - packet_wire / float(capacity)
+        plan[serial] = {
+            'interPacketDelay': int(numpy.ceil(gap / tick)),
+            'share': share,
+            'offset': 0.0,
+            'done': total / usable
+        }
+    return plan
+
+
 if __name__ == "__main__":
     bfs = BlackflyServer()
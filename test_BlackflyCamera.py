@@ -0,0 +1,254 @@
+"""test_BlackflyCamera.py
+   Unit tests for the camera-independent helpers in BlackflyCamera.py.
+
+   Run with: python -m unittest test_BlackflyCamera
+   """
+
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from scipy.ndimage.morphology import binary_opening
+
+from BlackflyCamera import DefectMap, SparseImage, sparse_opening
+from BlackflyCamera import nth_largest_value, opening_in_roi
+from BlackflyCamera import exposure_to_shutter, shutter_to_exposure
+from BlackflyCamera import SiteFilter, DriftTracker
+
+
+class DefectMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def dark_frames(self, shape, hot):
+        frames = []
+        for i in range(4):
+            frame = numpy.full(shape, 3 + i % 2, dtype=numpy.uint8)
+            for r, c in hot:
+                frame[r, c] = 200
+            frames.append(frame)
+        return frames
+
+    def test_from_dark_frames_flags_hot_pixels(self):
+        hot = [(2, 3), (5, 0)]
+        frames = self.dark_frames((8, 10), hot)
+        defects = DefectMap.from_dark_frames(7, (0, 0, 10, 8), frames)
+        self.assertEqual(sorted(defects.bad_pixels), [2 * 10 + 3, 5 * 10 + 0])
+
+    def test_apply_interpolates_from_good_neighbors(self):
+        defects = DefectMap(7, (0, 0, 4, 3), (3, 4), [1 * 4 + 1])
+        data = numpy.arange(12, dtype=numpy.uint8).reshape(3, 4)
+        data[1, 1] = 255
+        defects.apply(data)
+        # mean of (0, 1), (2, 1), (1, 0), (1, 2)
+        self.assertEqual(data[1, 1], 5)
+
+    def test_apply_skips_bad_neighbors_and_borders(self):
+        defects = DefectMap(7, (0, 0, 3, 2), (2, 3), [0, 1])
+        data = numpy.array([[200, 200, 6], [2, 4, 8]], dtype=numpy.uint8)
+        defects.apply(data)
+        # (0, 0) only has (1, 0); (0, 1) has (1, 1) and (0, 2)
+        self.assertEqual(list(data[0]), [2, 5, 6])
+
+    def test_apply_mask_mode(self):
+        defects = DefectMap(7, (0, 0, 3, 3), (3, 3), [4])
+        data = numpy.full((3, 3), 9, dtype=numpy.uint8)
+        defects.apply(data, mode='mask')
+        self.assertEqual(data[1, 1], 0)
+        self.assertEqual(data.sum(), 8 * 9)
+
+    def test_apply_ignores_other_shapes(self):
+        defects = DefectMap(7, (0, 0, 3, 3), (3, 3), [4])
+        data = numpy.full((2, 2), 9, dtype=numpy.uint8)
+        defects.apply(data)
+        self.assertEqual(data.sum(), 4 * 9)
+
+    def test_crop_keeps_pixels_inside_roi(self):
+        defects = DefectMap.crop(7, (10, 20, 5, 4), [20, 23, 24, 21], [10, 14, 12, 9])
+        self.assertEqual(defects.shape, (4, 5))
+        self.assertEqual(list(defects.bad_pixels), [0, 3 * 5 + 4])
+        rows, cols = defects.sensor_pixels()
+        self.assertEqual(list(rows), [20, 23])
+        self.assertEqual(list(cols), [10, 14])
+
+    def test_load_missing_file(self):
+        self.assertIsNone(DefectMap.load(self.directory, 7, (0, 0, 4, 4)))
+
+    def test_save_and_load_in_another_roi(self):
+        DefectMap(7, (100, 50, 20, 10), (10, 20), [2 * 20 + 5]).save(self.directory)
+        defects = DefectMap.load(self.directory, 7, (104, 51, 8, 8))
+        self.assertEqual(list(defects.bad_pixels), [1 * 8 + 1])
+
+    def test_save_replaces_pixels_inside_roi_only(self):
+        DefectMap.crop(7, (0, 0, 40, 40), [5, 30], [5, 30]).save(self.directory)
+        # recalibrating (0, 0, 10, 10) finds (5, 5) healthy and (2, 2) hot
+        DefectMap.crop(7, (0, 0, 10, 10), [2], [2]).save(self.directory)
+        defects = DefectMap.load(self.directory, 7, (0, 0, 40, 40))
+        rows, cols = defects.sensor_pixels()
+        self.assertEqual(sorted(zip(rows, cols)), [(2, 2), (30, 30)])
+
+
+class SparseImageTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(1)
+        self.dense = rng.randint(0, 255, size=(12, 17)).astype(numpy.float64)
+        self.dense[self.dense < 180] = 0
+        flat = numpy.flatnonzero(self.dense)
+        self.sparse = SparseImage(flat, self.dense.flat[flat], self.dense.shape)
+
+    def test_dense_round_trip(self):
+        numpy.testing.assert_array_equal(self.sparse.dense(), self.dense)
+
+    def test_projection_matches_dense_sum(self):
+        for axis in (0, 1):
+            numpy.testing.assert_allclose(
+                self.sparse.projection(axis),
+                numpy.sum(self.dense, axis=axis)
+            )
+
+    def test_center_of_mass(self):
+        rows, cols = numpy.indices(self.dense.shape)
+        total = self.dense.sum()
+        numpy.testing.assert_allclose(
+            self.sparse.center_of_mass(),
+            [(rows * self.dense).sum() / total, (cols * self.dense).sum() / total]
+        )
+
+
+class SparseOpeningTest(unittest.TestCase):
+
+    def check(self, mask):
+        expected = numpy.flatnonzero(binary_opening(mask))
+        opened = sparse_opening(numpy.flatnonzero(mask), mask.shape)
+        numpy.testing.assert_array_equal(opened, expected)
+
+    def test_matches_binary_opening(self):
+        rng = numpy.random.RandomState(2)
+        for density in (0.3, 0.6, 0.9):
+            self.check(rng.random_sample((15, 21)) < density)
+
+    def test_blob_touching_the_border(self):
+        mask = numpy.zeros((6, 7), dtype=bool)
+        mask[0:4, 0:4] = True
+        self.check(mask)
+
+    def test_empty_mask(self):
+        self.check(numpy.zeros((4, 4), dtype=bool))
+
+
+class ScratchBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(3)
+        self.frame = rng.randint(0, 256, size=(30, 40)).astype(numpy.uint8)
+
+    def test_nth_largest_value(self):
+        scratch = numpy.empty(self.frame.shape, dtype=numpy.intp)
+        for n in (1, 10, 500):
+            expected = numpy.partition(self.frame.flatten(), -n)[-n]
+            self.assertEqual(nth_largest_value(self.frame, n), expected)
+            self.assertEqual(nth_largest_value(self.frame, n, scratch), expected)
+
+    def test_opening_in_roi_into_buffer(self):
+        mask = numpy.zeros(self.frame.shape, dtype=bool)
+        mask[5:15, 8:20] = self.frame[5:15, 8:20] > 60
+        out = numpy.ones(mask.shape, dtype=bool)
+        opened = opening_in_roi(mask, out)
+        self.assertIs(opened, out)
+        numpy.testing.assert_array_equal(opened, binary_opening(mask))
+        opening_in_roi(numpy.zeros(mask.shape, dtype=bool), out)
+        self.assertFalse(out.any())
+
+
+class ShutterTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for exposureTime in (0.08, 1.0, 18.0):
+            t = shutter_to_exposure(exposure_to_shutter(exposureTime))
+            self.assertAlmostEqual(t, exposureTime, delta=0.01)
+
+    def test_small_register_values_stay_positive(self):
+        for shutter_value in (0, 1, 5):
+            self.assertAlmostEqual(shutter_to_exposure(shutter_value), 0.07197)
+
+
+class SiteFilterTest(unittest.TestCase):
+
+    settings = {
+        'numSites': 3,
+        'spacing': 20,
+        'sigmaX': 4,
+        'sigmaY': 5,
+        'tolerance': 0.5,
+        'occupancyThreshold': 10
+    }
+
+    def frame(self, amplitudes, background=0.0):
+        rows, cols = numpy.indices((60, 100))
+        data = numpy.full((60, 100), float(background))
+        for k, a in enumerate(amplitudes):
+            xc = 50 + 20 * (k - 1)
+            data += a * numpy.exp(-(cols - xc)**2 / 32.0 - (rows - 30)**2 / 50.0)
+        return data
+
+    def test_reads_back_site_amplitudes(self):
+        site_filter = SiteFilter((60, 100), 50, 30, self.settings)
+        numpy.testing.assert_allclose(
+            site_filter.readout(self.frame([40, 0, 25])), [40, 0, 25], atol=1e-6)
+
+    def test_uniform_background_is_ignored(self):
+        site_filter = SiteFilter((60, 100), 50, 30, self.settings)
+        numpy.testing.assert_allclose(
+            site_filter.readout(self.frame([40, 0, 25], background=12)),
+            [40, 0, 25], atol=1e-6)
+
+    def test_window_is_clipped_to_the_frame(self):
+        site_filter = SiteFilter((20, 40), 10, 2, self.settings)
+        self.assertEqual(site_filter.window, (slice(0, 18), slice(0, 40)))
+        self.assertEqual(len(site_filter.readout(numpy.zeros((20, 40)))), 3)
+
+    def test_matches(self):
+        site_filter = SiteFilter((60, 100), 50, 30, self.settings)
+        self.assertTrue(site_filter.matches((60, 100), 50.4, 29.7, self.settings))
+        self.assertFalse(site_filter.matches((60, 100), 51, 30, self.settings))
+        self.assertFalse(site_filter.matches((60, 80), 50, 30, self.settings))
+        settings = dict(self.settings, spacing=21)
+        self.assertFalse(site_filter.matches((60, 100), 50, 30, settings))
+
+
+class DriftTrackerTest(unittest.TestCase):
+
+    def spot(self, row, col, shape=(80, 120)):
+        rows, cols = numpy.indices(shape)
+        data = 5 + 200 * numpy.exp(-((rows - row)**2 + (cols - col)**2) / 50.0)
+        return data.astype(numpy.uint8)
+
+    def test_no_shift_against_the_reference(self):
+        tracker = DriftTracker(self.spot(40, 60), (40, 60), (32, 32))
+        dy, dx = tracker.shift(self.spot(40, 60))
+        self.assertAlmostEqual(dy, 0, places=6)
+        self.assertAlmostEqual(dx, 0, places=6)
+
+    def test_subpixel_shift(self):
+        tracker = DriftTracker(self.spot(40, 60), (40, 60), (32, 32))
+        for row, col in [(41.5, 58.7), (38.2, 62.3)]:
+            dy, dx = tracker.shift(self.spot(row, col))
+            self.assertAlmostEqual(dy, row - 40, delta=0.25)
+            self.assertAlmostEqual(dx, col - 60, delta=0.25)
+
+    def test_window_is_clipped_to_the_frame(self):
+        tracker = DriftTracker(self.spot(12, 106), (12, 106), (32, 32))
+        self.assertEqual(tracker.window, (slice(0, 32), slice(88, 120)))
+        dy, dx = tracker.shift(self.spot(13, 105))
+        self.assertAlmostEqual(dy, 1, delta=0.25)
+        self.assertAlmostEqual(dx, -1, delta=0.25)
+
+
+if __name__ == '__main__':
+    unittest.main()
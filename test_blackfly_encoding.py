@@ -0,0 +1,144 @@
+"""test_blackfly_encoding.py
+   Unit tests for blackfly_encoding.py.
+
+   Run with: python -m unittest test_blackfly_encoding
+   """
+
+import json
+import unittest
+
+import numpy
+
+from blackfly_encoding import pack_columnar, unpack_columnar, dtype_to_json
+from blackfly_encoding import encode_frame, decode_frame, reduce_frame
+
+
+class ColumnarTest(unittest.TestCase):
+
+    entries = [
+        {'seq': 1, 'time': 10.5, 'stamp': 2.25, 'received': 10.25, 'error': 0,
+         'stats': {'X0': 1.5, 'EV0': 200.0, 'SITES0': [1.0, 2.0, 3.0]}},
+        {'seq': 2, 'time': 11.5, 'stamp': None, 'received': None, 'error': 1,
+         'stats': {'X0': 2.5, 'Y0': -4.0}}
+    ]
+
+    def round_trip(self, entries):
+        records = pack_columnar(entries)
+        # the header goes through JSON, the records as raw bytes
+        descr = json.loads(json.dumps(dtype_to_json(records.dtype)))
+        return unpack_columnar(descr, records.tobytes())
+
+    def test_record_fields(self):
+        records = self.round_trip(self.entries)
+        self.assertEqual(list(records['seq']), [1, 2])
+        self.assertEqual(list(records['error']), [0, 1])
+        self.assertEqual(records['stamp'][0], 2.25)
+        self.assertTrue(numpy.isnan(records['stamp'][1]))
+        self.assertTrue(numpy.isnan(records['received'][1]))
+
+    def test_stats_columns(self):
+        records = self.round_trip(self.entries)
+        self.assertEqual(list(records['X0']), [1.5, 2.5])
+        self.assertEqual(records['Y0'][1], -4.0)
+        # stats missing from an entry are NaN
+        self.assertTrue(numpy.isnan(records['Y0'][0]))
+        self.assertTrue(numpy.isnan(records['EV0'][1]))
+
+    def test_list_stats_become_sub_arrays(self):
+        records = self.round_trip(self.entries)
+        self.assertEqual(records['SITES0'].shape, (2, 3))
+        self.assertEqual(list(records['SITES0'][0]), [1.0, 2.0, 3.0])
+        self.assertTrue(numpy.isnan(records['SITES0'][1]).all())
+
+    def test_empty_history(self):
+        records = self.round_trip([])
+        self.assertEqual(len(records), 0)
+        self.assertIn('seq', records.dtype.names)
+
+
+class FrameEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(5)
+        self.reference = rng.randint(0, 30, (30, 40)).astype(numpy.uint8)
+        self.frame = self.reference.copy()
+        self.frame[10:15, 20:25] = 250
+        # pixels darker than the reference wrap around in the difference
+        self.frame[0, :5] = 0
+
+    def round_trip(self, method, reference=None):
+        buf, meta = encode_frame(self.frame, method, reference=reference)
+        if method == 'none':
+            # 'none' sends the frame itself, it arrives as raw bytes
+            buf = buf.tobytes()
+        return meta, decode_frame(buf, meta, reference)
+
+    def test_none(self):
+        meta, frame = self.round_trip('none')
+        self.assertEqual(meta['method'], 'none')
+        numpy.testing.assert_array_equal(frame, self.frame)
+
+    def test_zlib(self):
+        meta, frame = self.round_trip('zlib')
+        self.assertEqual(meta['method'], 'zlib')
+        self.assertEqual(frame.dtype, numpy.uint8)
+        numpy.testing.assert_array_equal(frame, self.frame)
+
+    def test_delta(self):
+        meta, frame = self.round_trip('delta', self.reference)
+        self.assertEqual(meta['method'], 'delta')
+        numpy.testing.assert_array_equal(frame, self.frame)
+
+    def test_delta_without_reference_is_a_key_frame(self):
+        meta, frame = self.round_trip('delta')
+        self.assertEqual(meta['method'], 'zlib')
+        numpy.testing.assert_array_equal(frame, self.frame)
+        meta, frame = self.round_trip('delta', self.reference[:20])
+        self.assertEqual(meta['method'], 'zlib')
+        numpy.testing.assert_array_equal(frame, self.frame)
+
+    def test_delta_is_smaller_for_similar_frames(self):
+        key, meta = encode_frame(self.frame, 'zlib')
+        delta, meta = encode_frame(self.frame, 'delta', reference=self.reference)
+        self.assertLess(len(delta), len(key))
+
+
+class ReduceFrameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.frame = numpy.arange(6 * 8, dtype=numpy.uint8).reshape(6, 8)
+
+    def test_no_reduction(self):
+        self.assertIs(reduce_frame(self.frame), self.frame)
+
+    def test_roi(self):
+        cropped = reduce_frame(self.frame, roi=[2, 1, 3, 2])
+        numpy.testing.assert_array_equal(cropped, self.frame[1:3, 2:5])
+
+    def test_roi_is_clipped_to_the_frame(self):
+        cropped = reduce_frame(self.frame, roi=[-2, 4, 100, 100])
+        numpy.testing.assert_array_equal(cropped, self.frame[4:, :])
+
+    def test_binning_averages_whole_blocks(self):
+        binned = reduce_frame(self.frame, binning=4)
+        self.assertEqual(binned.dtype, numpy.uint8)
+        # the last two rows do not fill a block and are dropped
+        expected = [[self.frame[:4, :4].mean(), self.frame[:4, 4:].mean()]]
+        numpy.testing.assert_array_equal(binned, numpy.floor(expected))
+
+    def test_binning_does_not_overflow(self):
+        frame = numpy.full((4, 4), 255, dtype=numpy.uint8)
+        numpy.testing.assert_array_equal(reduce_frame(frame, binning=2), 255)
+
+    def test_stride(self):
+        strided = reduce_frame(self.frame, stride=3)
+        numpy.testing.assert_array_equal(strided, self.frame[::3, ::3])
+
+    def test_order_crop_bin_stride(self):
+        reduced = reduce_frame(self.frame, roi=[0, 0, 8, 4], binning=2, stride=2)
+        binned = self.frame[:4].reshape(2, 2, 4, 2).mean(axis=(1, 3))
+        numpy.testing.assert_array_equal(reduced, numpy.floor(binned)[::2, ::2])
+
+
+if __name__ == '__main__':
+    unittest.main()
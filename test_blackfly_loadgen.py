@@ -0,0 +1,68 @@
+"""test_blackfly_loadgen.py
+   Unit tests for the mix parsing and statistics of blackfly_loadgen.py.
+
+   Run with: python -m unittest test_blackfly_loadgen
+   """
+
+import unittest
+
+from blackfly_loadgen import parse_mix, summarize
+
+
+class ParseMixTest(unittest.TestCase):
+
+    def test_weights(self):
+        self.assertEqual(
+            parse_mix('ECHO=5, get_results=0.5,GET_IMAGE'),
+            [('ECHO', 5.0), ('GET_RESULTS', 0.5), ('GET_IMAGE', 1.0)]
+        )
+
+    def test_unknown_action(self):
+        self.assertRaises(ValueError, parse_mix, 'ECHO=1,REBOOT=1')
+
+    def test_update_is_opt_in(self):
+        self.assertRaises(ValueError, parse_mix, 'ECHO=1,UPDATE=1')
+        self.assertEqual(
+            parse_mix('ECHO=1,UPDATE=1', allow_update=True),
+            [('ECHO', 1.0), ('UPDATE', 1.0)]
+        )
+
+
+class SummarizeTest(unittest.TestCase):
+
+    def test_percentiles_and_rates(self):
+        # (latency s, service time s, outcome)
+        samples = [(0.001 * i, 0.0005 * i, 'ok') for i in range(1, 101)]
+        samples[0] = (0.001, 0.0005, 'status')
+        samples.append((5.0, 5.0, 'timeout'))
+        summary = summarize(samples, 10.0)
+        self.assertEqual(summary['count'], 101)
+        self.assertAlmostEqual(summary['errors'], 1 / 101.0)
+        self.assertAlmostEqual(summary['timeouts'], 1 / 101.0)
+        # timed out requests are left out of throughput and percentiles
+        self.assertAlmostEqual(summary['throughput'], 10.0)
+        self.assertAlmostEqual(summary['p50'], 50.5)
+        self.assertAlmostEqual(summary['p99'], 99.01)
+        self.assertAlmostEqual(summary['service_p50'], 25.25)
+        self.assertAlmostEqual(summary['max'], 100.0)
+
+    def test_latency_includes_the_wait_before_the_send(self):
+        summary = summarize([(0.030, 0.010, 'ok')], 1.0)
+        self.assertAlmostEqual(summary['p50'], 30.0)
+        self.assertAlmostEqual(summary['service_p50'], 10.0)
+
+    def test_only_timeouts(self):
+        summary = summarize([(5.0, 5.0, 'timeout')], 1.0)
+        self.assertEqual(summary['throughput'], 0.0)
+        self.assertIsNone(summary['p99'])
+        self.assertIsNone(summary['max'])
+
+    def test_no_samples(self):
+        summary = summarize([], 1.0)
+        self.assertEqual(summary['count'], 0)
+        self.assertEqual(summary['errors'], 0.0)
+        self.assertIsNone(summary['p50'])
+
+
+if __name__ == '__main__':
+    unittest.main()
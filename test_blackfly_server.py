@@ -0,0 +1,89 @@
+"""test_blackfly_server.py
+   Unit tests for request handlers of blackfly_server.py that need no camera.
+
+   Run with: python -m unittest test_blackfly_server
+   """
+
+import unittest
+
+import numpy
+
+from blackfly_server import BlackflyServer
+from blackfly_encoding import decode_frame
+
+
+class RecordingSocket(object):
+    """Collects the parts of each multipart reply."""
+
+    def __init__(self):
+        self.replies = []
+        self.parts = []
+
+    def send_json(self, obj, flags=0):
+        self.send(obj, flags)
+
+    def send(self, data, flags=0, copy=True):
+        self.parts.append(data)
+        if not flags:
+            self.replies.append(self.parts)
+            self.parts = []
+
+
+class LastFrames(object):
+    """Stands in for a BlackflyCamera that finished measurement `seq`."""
+
+    def __init__(self, seq, frames):
+        self.frames = (seq, 0, frames)
+
+    def last_frames(self):
+        return self.frames
+
+
+class GetImageTest(unittest.TestCase):
+
+    def setUp(self):
+        # the handlers only need the camera table, the socket and the cache
+        self.server = BlackflyServer.__new__(BlackflyServer)
+        self.server.socket = RecordingSocket()
+        self.server.sent_frames = {}
+        rng = numpy.random.RandomState(4)
+        self.frames = [rng.randint(0, 20, (30, 40)).astype(numpy.uint8)]
+        self.server.cameras = {7: LastFrames(3, self.frames)}
+
+    def request(self, **msg):
+        msg.update({'action': 'GET_IMAGE', 'serial': 7, 'client': 'viewer'})
+        self.server.get_image(msg)
+        header, buffers = self.server.socket.replies[-1][0], self.server.socket.replies[-1][1:]
+        return header, buffers
+
+    def test_delta_needs_the_held_measurement(self):
+        header, buffers = self.request(compression='delta')
+        self.assertEqual(header['seq'], 3)
+        self.assertEqual(header['frames'][0]['method'], 'zlib')
+        header, buffers = self.request(compression='delta', have=2)
+        self.assertEqual(header['frames'][0]['method'], 'zlib')
+
+    def test_repeated_delta_requests(self):
+        header, buffers = self.request(compression='delta')
+        reference = decode_frame(buffers[0], header['frames'][0])
+        for i in range(2):
+            header, buffers = self.request(compression='delta', have=header['seq'])
+            self.assertEqual(header['seq'], 3)
+            self.assertEqual(header['frames'][0]['method'], 'delta')
+            frame = decode_frame(buffers[0], header['frames'][0], reference)
+            numpy.testing.assert_array_equal(frame, self.frames[0])
+
+    def test_delta_after_a_new_measurement(self):
+        header, buffers = self.request(compression='delta')
+        reference = decode_frame(buffers[0], header['frames'][0])
+        new_frame = self.frames[0] + 1
+        self.server.cameras[7] = LastFrames(4, [new_frame])
+        header, buffers = self.request(compression='delta', have=header['seq'])
+        self.assertEqual(header['seq'], 4)
+        self.assertEqual(header['frames'][0]['method'], 'delta')
+        frame = decode_frame(buffers[0], header['frames'][0], reference)
+        numpy.testing.assert_array_equal(frame, new_frame)
+
+
+if __name__ == '__main__':
+    unittest.main()